@@ -1,12 +1,27 @@
 import os
-from typing import List
+import math
+import weakref
+import hashlib
+from copy import deepcopy
+from collections import OrderedDict
+from typing import List, NamedTuple
 import numpy as np
 import torch
 from torch import nn
 from torch.utils.data import DataLoader
 
 
+def tensor_fingerprint(tensor: torch.Tensor) -> str:
+    data = tensor.detach().cpu().contiguous().view(-1)
+    return hashlib.sha1(data.view(torch.uint8).numpy().tobytes()).hexdigest()
+
+
 class BaseModel(nn.Module):
+    # attributes holding method state outside the network (old deltas, prototypes, Fisher, ...), saved in checkpoints
+    checkpoint_attributes = ()
+    # attributes read by the forward besides the network and the checkpoint ones, synced to the evaluation copies
+    eval_attributes = ()
+
     def __init__(
         self,
         fabric,
@@ -34,24 +49,81 @@ class BaseModel(nn.Module):
         self.cpt = 0
         self.augment = None
         self.test_transform = None
+        self._fingerprints = {}
+
+    def cached_fingerprint(self, name: str, tensor: torch.Tensor) -> str:
+        # hashed again only if the tensor was replaced, has a new storage or was updated in place
+        signature = (tensor.data_ptr(), tensor._version)
+        cached = self._fingerprints.get(name)
+        if cached is None or cached[0]() is not tensor or cached[1] != signature:
+            cached = (weakref.ref(tensor), signature, tensor_fingerprint(tensor))
+            self._fingerprints[name] = cached
+        return cached[2]
+
+    def fingerprint_network(self) -> None:
+        # fingerprints of the network as built from the pretrained source, checkpoints only store what differs from it
+        state_dict = self.network.state_dict(keep_vars=True)
+        self.network_fingerprints = {name: self.cached_fingerprint(name, tensor) for name, tensor in state_dict.items()}
+
+    def checkpoint_name(self, task: int, comm_round: int) -> str:
+        return "checkpoint.pt"
+
+    def get_checkpoint_state(self) -> dict:
+        return {name: getattr(self, name) for name in self.checkpoint_attributes if hasattr(self, name)}
+
+    def set_checkpoint_state(self, state: dict) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def save_checkpoint(self, output_folder: str, task: int, comm_round: int) -> None:
         training_status = self.network.training
         self.network.eval()
 
+        # trainable tensors and frozen ones that changed are saved, the others only by fingerprint
+        baseline = getattr(self, "network_fingerprints", None)
+        network, frozen = {}, {}
+        for name, tensor in self.network.state_dict(keep_vars=True).items():
+            if not tensor.requires_grad and baseline is not None and name in baseline:
+                fingerprint = self.cached_fingerprint(name, tensor)
+                if fingerprint == baseline[name]:
+                    frozen[name] = fingerprint
+                    continue
+            network[name] = tensor.detach()
         checkpoint = {
             "task": task,
             "comm_round": comm_round,
-            "network": self.network,
-            "optimizer": self.optimizer,
+            "network": network,
+            "frozen": frozen,
+            "state": self.get_checkpoint_state(),
         }
-        self.fabric.save(os.path.join(output_folder, "checkpoint.pt"), checkpoint)
+        if self.optimizer is not None:
+            checkpoint["optimizer"] = self.optimizer
+        self.fabric.save(os.path.join(output_folder, self.checkpoint_name(task, comm_round)), checkpoint)
         self.network.train(training_status)
 
     def load_checkpoint(self, checkpoint_path: str) -> int:
         checkpoint = self.fabric.load(checkpoint_path)
-        self.network.load_state_dict(checkpoint["network"])
-        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        if "frozen" in checkpoint:
+            # the frozen tensors are not in the checkpoint, they must match the pretrained ones the network was built with
+            state_dict = self.network.state_dict()
+            mismatched = [name for name in checkpoint["network"] if name not in state_dict]
+            mismatched += [name for name in state_dict if name not in checkpoint["network"] and name not in checkpoint["frozen"]]
+            mismatched += [
+                name
+                for name, fingerprint in checkpoint["frozen"].items()
+                if name not in state_dict or tensor_fingerprint(state_dict[name]) != fingerprint
+            ]
+            if len(mismatched) > 0:
+                raise ValueError(
+                    f"Checkpoint {checkpoint_path} does not match the network: {len(mismatched)} tensors differ "
+                    f"(e.g. {', '.join(mismatched[:3])})"
+                )
+            self.network.load_state_dict(checkpoint["network"], strict=False)
+            self.set_checkpoint_state(checkpoint["state"])
+        else:
+            self.network.load_state_dict(checkpoint["network"])
+        if "optimizer" in checkpoint and self.optimizer is not None:
+            self.optimizer.load_state_dict(checkpoint["optimizer"])
 
         return checkpoint["task"], checkpoint["comm_round"]
 
@@ -85,6 +157,10 @@ class BaseModel(nn.Module):
     def begin_round_server(self, info: List[dict] = None):
         pass
 
+    def receive_client_info(self, client_info: dict) -> dict:
+        # called on the server as soon as a client info arrives, what it returns is passed to end_round_server
+        return client_info
+
     def end_round_server(self, client_info: List[dict]):
         pass
 
@@ -135,10 +211,24 @@ def reservoir(num_seen_examples: int, buffer_size: int) -> int:
         return -1
 
 
+def reservoir_indexes(num_seen_examples: int, buffer_size: int, n: int) -> np.ndarray:
+    # reservoir() for n consecutive examples in a single draw, -1 where the example is discarded
+    seen = num_seen_examples + np.arange(n)
+    rand = np.random.randint(0, seen + 1)
+    return np.where(seen < buffer_size, seen, np.where(rand < buffer_size, rand, -1))
+
+
 class Buffer:
-    def __init__(self, buffer_size, device="cpu"):
+    """Reservoir buffer.
+
+    With compact=True, float images (N, C, H, W) with values in [0, 1] are stored as uint8 and the other float
+    attributes (e.g. logits) as float16; get_data restores the original dtypes.
+    """
+
+    def __init__(self, buffer_size, device="cpu", compact: bool = False):
         self.buffer_size = buffer_size
         self.device = device
+        self.compact = compact
         self.num_seen_examples = 0
 
     def to(self, device):
@@ -153,10 +243,29 @@ class Buffer:
         return min(self.num_seen_examples, self.buffer_size)
 
     def init_tensors(self, **kwargs) -> None:
+        self.dtypes = {}
         for attr_str in self.attributes:
-            setattr(self, attr_str, torch.zeros((self.buffer_size,
-                    *kwargs[attr_str].shape[1:]), dtype=kwargs[attr_str].dtype,
-                    device=self.device))
+            value = kwargs[attr_str]
+            dtype = value.dtype
+            if self.compact and value.is_floating_point():
+                if value.dim() == 4 and value.numel() > 0 and value.min() >= 0 and value.max() <= 1:
+                    dtype = torch.uint8
+                else:
+                    dtype = torch.float16
+            self.dtypes[attr_str] = value.dtype
+            setattr(self, attr_str, torch.zeros((self.buffer_size, *value.shape[1:]), dtype=dtype, device=self.device))
+
+    def encode(self, attr_str: str, value: torch.Tensor) -> torch.Tensor:
+        dtype = getattr(self, attr_str).dtype
+        if dtype == torch.uint8 and value.is_floating_point():
+            return value.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+        return value.to(dtype)
+
+    def decode(self, attr_str: str, value: torch.Tensor) -> torch.Tensor:
+        dtype = self.dtypes[attr_str]
+        if value.dtype == torch.uint8 and dtype.is_floating_point:
+            return value.to(dtype).div_(255)
+        return value.to(dtype)
 
     def add_data(self, **kwargs):
         if hasattr(self, 'attributes'):
@@ -165,13 +274,21 @@ class Buffer:
             self.attributes = list(kwargs.keys())
             self.init_tensors(**kwargs)
 
-        for i in range(kwargs[self.attributes[0]].shape[0]):
-            index = reservoir(self.num_seen_examples, self.buffer_size)
-            self.num_seen_examples += 1
-            if index >= 0:
-                for attr_str in self.attributes:
-                    attribute = getattr(self, attr_str)
-                    attribute[index] = kwargs[attr_str][i].to(self.device)
+        n = kwargs[self.attributes[0]].shape[0]
+        indexes = reservoir_indexes(self.num_seen_examples, self.buffer_size, n)
+        self.num_seen_examples += n
+        positions = np.nonzero(indexes >= 0)[0]
+        if len(positions) == 0:
+            return
+        # when two examples draw the same slot only the last one is kept, as with sequential insertion
+        _, last = np.unique(indexes[positions][::-1], return_index=True)
+        positions = positions[::-1][last]
+        rows = torch.from_numpy(indexes[positions]).to(self.device)
+        positions = torch.from_numpy(positions)
+        for attr_str in self.attributes:
+            value = kwargs[attr_str].detach()
+            value = value[positions.to(value.device)].to(self.device)
+            getattr(self, attr_str)[rows] = self.encode(attr_str, value)
 
     def get_data(self, size: int, device=None, shuffle=True):
         target_device = self.device if device is None else device
@@ -182,7 +299,9 @@ class Buffer:
         else:
             choice = np.arange(actual_size)
 
-        return [getattr(self, attr_str)[choice].to(target_device) for attr_str in self.attributes]
+        return [
+            self.decode(attr_str, getattr(self, attr_str)[choice].to(target_device)) for attr_str in self.attributes
+        ]
 
     def is_empty(self) -> bool:
         return True if self.num_seen_examples == 0 else False
@@ -195,3 +314,227 @@ class Buffer:
         self.attributes = None
         delattr(self, "attributes")
         self.num_seen_examples = 0
+
+
+class ClassStatistics:
+    """Streaming per-class count, sum and sum of outer products (or of squares, when full_cov is False) of features,
+    accumulated in float64 for the classes offset, ..., offset + num_classes - 1.
+    """
+
+    def __init__(self, num_classes: int, dim: int, full_cov: bool = False, offset: int = 0, device="cpu"):
+        self.offset = offset
+        self.full_cov = full_cov
+        self.count = torch.zeros(num_classes, dtype=torch.float64, device=device)
+        self.sum = torch.zeros(num_classes, dim, dtype=torch.float64, device=device)
+        if full_cov:
+            self.sum_sq = torch.zeros(num_classes, dim, dim, dtype=torch.float64, device=device)
+        else:
+            self.sum_sq = torch.zeros(num_classes, dim, dtype=torch.float64, device=device)
+
+    def update(self, features: torch.Tensor, labels: torch.Tensor) -> None:
+        features = features.detach().to(self.sum.device, torch.float64)
+        indexes = labels.to(self.sum.device) - self.offset
+        valid = (indexes >= 0) & (indexes < self.count.shape[0])
+        features, indexes = features[valid], indexes[valid]
+        self.count.index_add_(0, indexes, torch.ones_like(indexes, dtype=torch.float64))
+        self.sum.index_add_(0, indexes, features)
+        if self.full_cov:
+            for index in torch.unique(indexes).tolist():
+                class_features = features[indexes == index]
+                self.sum_sq[index].addmm_(class_features.T, class_features)
+        else:
+            self.sum_sq.index_add_(0, indexes, features**2)
+
+    def gaussians(self, min_count: int = 2, dtype=torch.float32) -> dict:
+        # {class: [count, mean, unbiased covariance (or variances)]} for the classes with at least min_count samples
+        gaussians = {}
+        for index in torch.nonzero(self.count >= min_count).view(-1).tolist():
+            n = self.count[index]
+            mean = self.sum[index] / n
+            if self.full_cov:
+                cov = (self.sum_sq[index] - n * torch.outer(mean, mean)) / (n - 1)
+            else:
+                cov = ((self.sum_sq[index] - n * mean**2) / (n - 1)).clamp_(min=0)
+            gaussians[index + self.offset] = [int(n.item()), mean.to(dtype), cov.to(dtype)]
+        return gaussians
+
+
+_BITS_VIEW = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+class SharedTeacher:
+    """Frozen teacher network for distillation, shared by the clients instead of being deepcopied by each of them.
+
+    `load` copies the network the first time and whenever the task changes (so that the state outside the
+    parameters, e.g. the task counter of the prompts, follows the students), otherwise it only reloads the weights
+    when `params` change. `outputs` computes the teacher outputs of each sample once and serves them again (later
+    epochs, rounds, or other clients) while the weights, task and mode do not change. The training loaders do not
+    yield sample indexes, so samples are looked up by a 256-bit fingerprint of the bit pattern of their inputs. At most
+    `cache_size` outputs are kept, on CPU, the least recently used are evicted first. Use `for_run` to get the
+    teacher of a run.
+    """
+
+    _runs = weakref.WeakKeyDictionary()
+
+    def __init__(self, cache_size: int = 50000):
+        self.network = None
+        self.params = None
+        self.task = None
+        self.train = None
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self._weights = {}
+
+    @classmethod
+    def for_run(cls, fabric, cache_size: int = 50000) -> "SharedTeacher":
+        # one teacher per run (fabric), released with it
+        if fabric not in cls._runs:
+            cls._runs[fabric] = cls(cache_size)
+        cls._runs[fabric].cache_size = cache_size
+        return cls._runs[fabric]
+
+    def __deepcopy__(self, memo):
+        # snapshots of a model keep sharing the teacher of the run
+        return self
+
+    def load(self, network: nn.Module, params: torch.Tensor, train: bool = False, task: int = None) -> nn.Module:
+        if self.network is None or task != self.task or self.network.get_params().numel() != params.numel():
+            self.network = deepcopy(network)
+            self.task = task
+            self.params = None
+        self.network.to(next(network.parameters()).device)
+        self.network.train(train)
+        if train != self.train:
+            self.train = train
+            self.cache.clear()
+        if self.params is None or not (params is self.params or torch.equal(params, self.params.to(params.device))):
+            self.network.set_params(params)
+            self.params = params.detach()
+            self.cache.clear()
+        return self.network
+
+    def fingerprint(self, inputs: torch.Tensor) -> List[tuple]:
+        # four random weighted sums (wrapping 64-bit integer arithmetic) of the bits of each sample
+        bits = inputs.detach().flatten(1).contiguous().view(_BITS_VIEW[inputs.element_size()]).long()
+        key = (bits.shape[1], bits.device)
+        if key not in self._weights:
+            generator = torch.Generator().manual_seed(bits.shape[1])
+            self._weights[key] = torch.randint(1, 2**62, (4, bits.shape[1]), generator=generator).to(bits.device)
+        sums = torch.stack([(bits * weights).sum(1) for weights in self._weights[key]], dim=1)
+        return [(tuple(inputs.shape[1:]), inputs.dtype, *row) for row in sums.tolist()]
+
+    def outputs(self, inputs: torch.Tensor, forward) -> torch.Tensor:
+        keys = self.fingerprint(inputs)
+        outputs = [self.cache.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if len(missing) > 0:
+            with torch.no_grad():
+                new_outputs = forward(inputs[torch.tensor(missing, device=inputs.device)]).detach()
+            for i, output in zip(missing, new_outputs.to("cpu").unbind(0)):
+                outputs[i] = output
+                self.cache[keys[i]] = output
+        for key in keys:
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return torch.stack(outputs).to(inputs.device)
+
+
+def _eigh_solve(E: torch.Tensor, G: torch.Tensor, rcond: float) -> torch.Tensor:
+    # pseudo-inverse solution through the eigendecomposition of the symmetric G, as torch.pinverse would give
+    eigvals, eigvecs = torch.linalg.eigh(G)
+    cutoff = rcond * eigvals.abs().amax(dim=-1, keepdim=True)
+    inv_eigvals = torch.where(eigvals.abs() > cutoff, 1 / eigvals, torch.zeros_like(eigvals))
+    return ((E @ eigvecs) * inv_eigvals.unsqueeze(-2)) @ eigvecs.transpose(-1, -2)
+
+
+def solve_gram(E: torch.Tensor, G: torch.Tensor, rcond: float = 1e-15) -> torch.Tensor:
+    """Solves X G = E for symmetric positive semi-definite G, for a single system or a batch of them.
+
+    Uses a Cholesky factorization, and falls back to the eigendecomposition of G (pseudo-inverse) for the systems
+    where the factorization fails or G is ill-conditioned.
+    """
+    batched = G.dim() == 3
+    if not batched:
+        E, G = E.unsqueeze(0), G.unsqueeze(0)
+    L, info = torch.linalg.cholesky_ex(G)
+    diag = L.diagonal(dim1=-2, dim2=-1).abs()
+    max_cond = 1 / (torch.finfo(G.dtype).eps * G.shape[-1])
+    well_conditioned = (info == 0) & ((diag.amax(dim=-1) / diag.amin(dim=-1)) ** 2 < max_cond)
+    X = torch.cholesky_solve(E.transpose(-1, -2), L).transpose(-1, -2)
+    well_conditioned &= torch.isfinite(X).flatten(1).all(dim=1)
+    if not well_conditioned.all():
+        X[~well_conditioned] = _eigh_solve(E[~well_conditioned], G[~well_conditioned], rcond)
+    return X if batched else X.squeeze(0)
+
+
+def solve_gram_systems(systems: dict, device: str = None, batch_size: int = 16, memory_budget: int = 2**30) -> dict:
+    """Solves {key: (E, G)} systems X G = E, batching together the ones with the same shapes.
+
+    Each batch is moved to `device` (if given) for the solve, the solutions are returned on the device of E.
+    Batches are capped so that a solve needs about `memory_budget` bytes at most, systems larger than the
+    budget are solved one at a time.
+    """
+    groups = {}
+    for key, (E, G) in systems.items():
+        groups.setdefault((tuple(E.shape), tuple(G.shape), E.dtype), []).append(key)
+    solutions = {}
+    for (E_shape, G_shape, dtype), keys in groups.items():
+        # E, G, the factor (or eigenvectors) of G and X, all of them stacked for the batch
+        system_bytes = (2 * math.prod(E_shape) + 2 * math.prod(G_shape)) * torch.finfo(dtype).bits // 8
+        group_batch_size = max(1, min(batch_size, memory_budget // max(system_bytes, 1)))
+        for i in range(0, len(keys), group_batch_size):
+            batch_keys = keys[i : i + group_batch_size]
+            out_device = systems[batch_keys[0]][0].device
+            E = torch.stack([systems[key][0] for key in batch_keys])
+            G = torch.stack([systems[key][1].to(E.device) for key in batch_keys])
+            if device is not None:
+                E, G = E.to(device), G.to(device)
+            X = solve_gram(E, G).to(out_device)
+            del E, G
+            for key, x in zip(batch_keys, X.unbind(0)):
+                solutions[key] = x
+    return solutions
+
+
+class PackedGram(NamedTuple):
+    """Upper triangle (row-major) of a symmetric Gram matrix, divided by `scale`."""
+
+    values: torch.Tensor
+    scale: float
+    size: int
+
+
+def pack_gram(gram: torch.Tensor, dtype: torch.dtype = None) -> PackedGram:
+    # the scale keeps large Gram entries within the range of half precision
+    dtype = gram.dtype if dtype is None else dtype
+    rows, cols = torch.triu_indices(gram.shape[0], gram.shape[1], device=gram.device)
+    values = gram[rows, cols]
+    scale = 1.0
+    if dtype in (torch.float16, torch.bfloat16) and values.numel() > 0:
+        scale = max(values.abs().max().item(), 1e-12)
+        values = values / scale
+    return PackedGram(values.to(dtype), scale, gram.shape[0])
+
+
+def unpack_gram(gram, dtype: torch.dtype = None) -> torch.Tensor:
+    # dense Gram matrices are returned as they are, half precision ones are restored in float32 by default
+    if not isinstance(gram, PackedGram):
+        return gram if dtype is None else gram.to(dtype)
+    if dtype is None:
+        dtype = torch.float32 if gram.values.dtype in (torch.float16, torch.bfloat16) else gram.values.dtype
+    values = gram.values.to(dtype) * gram.scale
+    rows, cols = torch.triu_indices(gram.size, gram.size, device=values.device)
+    dense = torch.zeros(gram.size, gram.size, dtype=dtype, device=values.device)
+    dense[rows, cols] = values
+    dense[cols, rows] = values
+    return dense
+
+
+def regularize_gram_(gram: torch.Tensor, alpha: float) -> torch.Tensor:
+    # in place G * alpha + (1 - alpha) * diag(G): scales the off-diagonal entries only
+    if gram.dim() == 2:
+        diagonal = gram.diagonal().clone()
+        gram.mul_(alpha)
+        gram.diagonal().copy_(diagonal)
+    return gram
@@ -1,18 +1,18 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
-from torch.distributions import MultivariateNormal
 from _models import register_model
 from typing import List
 from torch.utils.data import DataLoader
-from _models._utils import BaseModel
+from _models._utils import BaseModel, ClassStatistics
 from _networks.vit import VisionTransformer as Vit
-import os
 from utils.tools import str_to_bool
 
 
 @register_model("ccvr")
 class CCVR(BaseModel):
+    checkpoint_attributes = ("mogs",)
+
     def __init__(
         self,
         fabric,
@@ -32,6 +32,7 @@ class CCVR(BaseModel):
         self.how_many = how_many
         self.clients_statistics = None
         self.mogs = {}
+        self.sampler = None
         self.logit_norm = 0.1
         self.full_cov = full_cov
         self.do_linear_probe = linear_probe
@@ -119,52 +120,16 @@ class CCVR(BaseModel):
             optimizer = torch.optim.SGD(self.network.head.parameters(), lr=0.01, momentum=0.9, weight_decay=0)
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer=optimizer, T_max=5)
         logits_norm = torch.tensor([], dtype=torch.float32).to(self.device)
+        self.build_sampler()
         for epoch in range(5):
-            sampled_data = []
-            sampled_label = []
             # TODO: fix the probabilities of the classes
             # since Cifar100 and Tiny-ImageNet are balanced datasets and the participation rate is 100%,
             # we can set classes_weights asequiprobable
             num_cur_classes = self.cpt[-1]
             classes_weights = torch.ones(num_cur_classes, dtype=torch.float32).to(self.device)
             classes_samples = torch.multinomial(classes_weights, self.how_many * num_cur_classes, replacement=True)
-            _, classes_samples = torch.unique(classes_samples, return_counts=True)
-            # sample features from gaussians:
-            for clas in range(self.cur_offset, self.cur_offset + self.cpt[-1]):
-                if self.mogs.get([clas][0]) is None:
-                    #print("No gaussian for class ", task * self.cpt + clas)
-                    continue
-                weights_list = []
-                for weight in self.mogs[clas][0]:
-                    weights_list.append(weight)
-                gaussian_samples = torch.zeros(len(weights_list), dtype=torch.int64).to(self.device)
-                weights_list = torch.tensor(weights_list, dtype=torch.float32).to(self.device)
-                gaussian_samples_fill = torch.multinomial(
-                        weights_list, classes_samples[clas - self.cur_offset], replacement=True
-                )
-                gaussian_clients, gaussian_samples_fill = torch.unique(gaussian_samples_fill, return_counts=True)
-                gaussian_samples[gaussian_clients] += gaussian_samples_fill
-                for id, (mean, variance) in enumerate(
-                    zip(
-                        self.mogs[clas][1],
-                        self.mogs[clas][2],
-                    )
-                ):
-                    cls_mean = mean  # * (0.9 + decay)
-                    cls_var = variance
-                    if self.full_cov:
-                        cov = cls_var + 1e-8 * torch.eye(cls_mean.shape[-1]).to(self.device)
-                    else:
-                        cov = (torch.eye(cls_mean.shape[-1]).to(self.device) * cls_var) + (1e-8 * torch.eye(cls_mean.shape[-1]).to(self.device))
-                    m = MultivariateNormal(cls_mean, cov)
-                    n_samples = int(torch.round(gaussian_samples[id]))
-                    sampled_data_single = m.sample((n_samples,))
-                    sampled_data.append(sampled_data_single)
-                    sampled_label.extend([clas] * n_samples)
-            sampled_data = torch.cat(sampled_data, 0).float().to(self.device)
-            sampled_label = torch.tensor(sampled_label, dtype=torch.int64).to(self.device)
-            inputs = sampled_data
-            targets = sampled_label
+            classes_samples = torch.bincount(classes_samples, minlength=num_cur_classes)
+            inputs, targets = self.sample_features(classes_samples)
 
             sf_indexes = torch.randperm(inputs.size(0))
             inputs = inputs[sf_indexes]
@@ -187,6 +152,59 @@ class CCVR(BaseModel):
                 optimizer.step()
             scheduler.step()
 
+    def build_sampler(self):
+        # factorizes the covariance of every client/class gaussian of the mixtures once, stacked in a single batch
+        means, covs, labels, weights = [], [], [], []
+        for clas in range(self.cur_offset, self.cur_offset + self.cpt[-1]):
+            if self.mogs.get(clas) is None:
+                continue
+            weights.append(torch.tensor(self.mogs[clas][0], dtype=torch.float32))
+            for mean, variance in zip(self.mogs[clas][1], self.mogs[clas][2]):
+                means.append(mean.to(self.device))
+                covs.append(variance.to(self.device))
+                labels.append(clas)
+        if len(means) == 0:
+            self.sampler = None
+            return
+        means = torch.stack(means).float()
+        covs = torch.stack(covs).float()
+        if self.full_cov:
+            covs = covs + 1e-8 * torch.eye(means.shape[-1], device=self.device)
+            factors, info = torch.linalg.cholesky_ex(covs)
+            failed = info != 0
+            if failed.any():
+                # covariances that are not numerically positive definite, square root through the eigendecomposition
+                eigvals, eigvecs = torch.linalg.eigh(covs[failed])
+                factors[failed] = eigvecs * eigvals.clamp(min=0).sqrt().unsqueeze(-2)
+        else:
+            factors = (covs + 1e-8).sqrt()
+        self.sampler = {
+            "means": means,
+            "factors": factors,
+            "labels": torch.tensor(labels, dtype=torch.int64, device=self.device),
+            "weights": weights,
+        }
+
+    def sample_features(self, classes_samples: torch.Tensor):
+        # all the features of an epoch are drawn with one batched product, components padded to the largest count
+        sampler = self.sampler
+        if sampler is None:
+            return torch.zeros(0, 0, device=self.device), torch.zeros(0, dtype=torch.int64, device=self.device)
+        counts = []
+        for i, clas in enumerate(torch.unique(sampler["labels"]).tolist()):
+            weights = sampler["weights"][i].to(self.device)
+            components = torch.multinomial(weights, int(classes_samples[clas - self.cur_offset]), replacement=True)
+            counts.append(torch.bincount(components, minlength=len(weights)))
+        counts = torch.cat(counts)
+        noise = torch.randn(counts.shape[0], int(counts.max()), sampler["means"].shape[-1], device=self.device)
+        if self.full_cov:
+            samples = torch.bmm(noise, sampler["factors"].transpose(1, 2))
+        else:
+            samples = noise * sampler["factors"].unsqueeze(1)
+        samples += sampler["means"].unsqueeze(1)
+        mask = torch.arange(noise.shape[1], device=self.device).unsqueeze(0) < counts.unsqueeze(1)
+        return samples[mask], sampler["labels"].unsqueeze(1).expand_as(mask)[mask]
+
     def begin_round_client(self, dataloader: DataLoader, server_info: dict):
         self.network.set_params(server_info["params"])
         if self.do_linear_probe and not self.done_linear_probe:
@@ -210,49 +228,24 @@ class CCVR(BaseModel):
         return {"params": self.network.get_params()}
 
     def end_round_client(self, dataloader: DataLoader):
-        features = torch.tensor([], dtype=torch.float32).to(self.device)
-        true_labels = torch.tensor([], dtype=torch.int64).to(self.device)
+        # features are reduced to per-class sufficient statistics as they are computed, they are never stored
+        statistics = None
         num_epochs = 1 if not self.full_cov else 3
         with torch.no_grad():
-            client_statistics = {}
             for _ in range(num_epochs):
                 for id, data in enumerate(dataloader):
                     inputs, labels = data
                     inputs, labels = inputs.to(self.device), labels.to(self.device)
                     outputs = self.network(inputs, penultimate=True)[0]
-                    features = torch.cat((features, outputs), 0)
-                    true_labels = torch.cat((true_labels, labels), 0)
-            client_labels = torch.unique(true_labels).tolist()
-            for client_label in client_labels:
-                number = (true_labels == client_label).sum().item()
-                if number > 1:
-                    gaussians = []
-                    gaussians.append(number)
-                    gaussians.append(torch.mean(features[true_labels == client_label], 0))
-                    if self.full_cov:
-                        gaussians.append(
-                            torch.cov(features[true_labels == client_label].T.type(torch.float64))
-                            .type(torch.float32)
-                            .to(self.device)
+                    if statistics is None:
+                        statistics = ClassStatistics(
+                            self.cpt[-1], outputs.shape[-1], self.full_cov, offset=self.cur_offset, device=self.device
                         )
-                    else:
-                        gaussians.append(torch.std(features[true_labels == client_label], 0) ** 2)
-                    client_statistics[client_label] = gaussians
-            self.clients_statistics = client_statistics
+                    statistics.update(outputs, labels)
+            self.clients_statistics = {} if statistics is None else statistics.gaussians()
 
-    def save_checkpoint(self, output_folder: str, task: int, comm_round: int) -> None:
-        training_status = self.network.training
-        self.network.eval()
-
-        checkpoint = {
-            "task": task,
-            "comm_round": comm_round,
-            "network": self.network,
-            "optimizer": self.optimizer,
-            "mogs": self.mogs,
-        }
+    def checkpoint_name(self, task: int, comm_round: int) -> str:
         name = "hgp_" + "full_cov" if self.full_cov else "diag_cov"
         name += "_linear_probe" if self.do_linear_probe else ""
         name += f"_task_{task}_round_{comm_round}_checkpoint.pt"
-        self.fabric.save(os.path.join(output_folder, name), checkpoint)
-        self.network.train(training_status)
+        return name
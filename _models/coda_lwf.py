@@ -5,8 +5,8 @@ from torch.distributions import MultivariateNormal
 from _models import register_model
 from typing import List
 from torch.utils.data import DataLoader
-from _models._utils import BaseModel
-from _networks.vit_powder import ViTZoo
+from _models._utils import BaseModel, SharedTeacher
+from _networks.vit_prompt_coda import ViTZoo
 import os
 from utils.tools import str_to_bool
 import math
@@ -90,6 +90,8 @@ class Coda_LwF(CodaPrompt):
         num_epochs: int = 5,
         clip_grads: str_to_bool = False,
         use_scheduler: str_to_bool = False,
+        teacher_cache: str_to_bool = False,
+        teacher_cache_size: int = 50000,
     ) -> None:
         linear_probe = False
         super().__init__(
@@ -111,15 +113,22 @@ class Coda_LwF(CodaPrompt):
         self.classes = None
         self.old_network = None
         self.betas = None
+        self.teacher_cache = teacher_cache  # teacher logits computed once per sample on the un-augmented inputs
+        self.teacher = SharedTeacher.for_run(fabric, teacher_cache_size)  # latest server model, shared by all the clients of the run
         #self.network.mark_forward_method(self.network.get_scores)
         self.network.mark_forward_method("get_scores")
 
     def observe(self, inputs: torch.Tensor, labels: torch.Tensor, update: bool = True) -> float:
         self.optimizer.zero_grad()
         with self.fabric.autocast():
-            inputs = self.augment(inputs)
             with torch.no_grad():
-                old_out = self.old_network(inputs, train=True)[0][:, self.cur_offset : self.cur_offset + self.cpt]
+                if self.teacher_cache:
+                    old_out = self.teacher.outputs(inputs, lambda x: self.old_network(self.test_transform(x), train=True)[0])
+                    inputs = self.augment(inputs)
+                else:
+                    inputs = self.augment(inputs)
+                    old_out = self.old_network(inputs, train=True)[0]
+                old_out = old_out[:, self.cur_offset : self.cur_offset + self.cpt]
             outputs = self.network(inputs, train=True)[0][:, self.cur_offset : self.cur_offset + self.cpt]
             loss_ce = self.loss(outputs, labels - self.cur_offset)
             loss_dual_full = F.kl_div(F.log_softmax(old_out, dim=1), F.softmax(outputs, dim=1), reduction="none")
@@ -166,7 +175,10 @@ class Coda_LwF(CodaPrompt):
 
     def begin_round_client(self, dataloader: DataLoader, server_info: dict):
         self.network.set_params(server_info["params"])
-        self.old_network = deepcopy(self.network) #latest server model
+        # latest server model
+        self.old_network = self.teacher.load(
+            self.network, server_info["params"], train=self.network.training, task=self.cur_task
+        )
         # restore correct optimizer
         params = [{"params": self.network.last.parameters()}, {"params": self.network.prompt.parameters()}]
         optimizer = self.optimizer_class(params, lr=self.lr, weight_decay=self.wd)
@@ -7,7 +7,6 @@ from typing import List
 from torch.utils.data import DataLoader
 from _models._utils import BaseModel
 from _networks.vit_prompt_coda import ViTZoo
-import os
 from utils.tools import str_to_bool
 import math
 
@@ -192,18 +191,8 @@ class CodaPrompt(BaseModel):
     def end_round_client(self, dataloader: DataLoader):
         pass
 
-    def save_checkpoint(self, output_folder: str, task: int, comm_round: int) -> None:
-        training_status = self.network.training
-        self.network.eval()
-
-        checkpoint = {
-            "task": task,
-            "comm_round": comm_round,
-            "network": self.network,
-            "optimizer": self.optimizer,
-        }
+    def checkpoint_name(self, task: int, comm_round: int) -> str:
         name = "coda"
         name += "_linear_probe" if self.do_linear_probe else ""
         name += f"_task_{task}_round_{comm_round}_checkpoint.pt"
-        self.fabric.save(os.path.join(output_folder, name), checkpoint)
-        self.network.train(training_status)
+        return name
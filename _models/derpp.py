@@ -29,7 +29,8 @@ class Derpp(BaseModel):
         slca: str_to_bool = False,
         buffer_size: int = 200,
         alpha: float=0.5,
-        beta: float=0.5
+        beta: float=0.5,
+        buffer_compact: str_to_bool = True,
     ) -> None:
         if type(network) == VitHGP:
             for n, p in network.named_parameters():
@@ -65,7 +66,7 @@ class Derpp(BaseModel):
         self.alpha = alpha
         self.beta = beta
         self.transform = None
-        self.buffer = Buffer(buffer_size, self.device)
+        self.buffer = Buffer(buffer_size, self.device, compact=buffer_compact)
 
     def observe(self, inputs: torch.Tensor, labels: torch.Tensor, update: bool = True) -> float:
         
@@ -6,7 +6,7 @@ from _models import register_model
 from typing import List
 from torch.utils.data import DataLoader
 from _models._utils import BaseModel
-from utils.tools import str_to_bool
+from utils.tools import str_to_bool, compute_fisher_diag
 from _networks.vit_prompt_hgp import VitHGP
 from torch.optim import SGD
 from _networks.vit import VisionTransformer
@@ -14,6 +14,7 @@ from _networks.vit import VisionTransformer
 
 @register_model("ewc")
 class EWC(BaseModel):
+    checkpoint_attributes = ("fish", "checkpoint")
 
     def __init__(
         self,
@@ -29,6 +30,8 @@ class EWC(BaseModel):
         slca: str_to_bool = False,
         ewc_lambda: float = 1,
         ewc_gamma: float = 0.9,
+        fisher_top_k: int = 0,
+        fisher_chunk_size: int = 16,
     ) -> None:
         if type(network) == VitHGP:
             for n, p in network.named_parameters():
@@ -69,6 +72,9 @@ class EWC(BaseModel):
         self.fish = None
         self.minibatch_size = 16
         self.round = 0
+        self.fisher_top_k = fisher_top_k
+        self.fisher_chunk_size = fisher_chunk_size if fisher_chunk_size > 0 else None
+        self.penalty = None
 
     def observe(self, inputs: torch.Tensor, labels: torch.Tensor, update: bool = True) -> float:
         if self.round == self.num_comm_rounds:
@@ -76,12 +82,12 @@ class EWC(BaseModel):
         else:
             with self.fabric.autocast():
                 inputs = self.augment(inputs)
-                if self.checkpoint is not None:
-                    self.network.module.set_grads(self.get_penalty_grads())
                 outputs = self.network(inputs)[:, self.cur_offset : self.cur_offset + self.cpt]
                 loss = self.loss(outputs, labels % self.cpt)
             if update:
                 self.fabric.backward(loss)
+                if self.penalty is not None:
+                    self.add_penalty_grads()
                 self.optimizer.step()
                 self.optimizer.zero_grad()
 
@@ -131,8 +137,31 @@ class EWC(BaseModel):
                 self.fish += sum([client["fisher"] for client in client_info]) / self.total_samples
         self.total_samples = None
 
-    def get_penalty_grads(self):
-        return self.ewc_lambda * 2 * self.fish * (self.network.module.get_params().data - self.checkpoint)
+    def set_penalty(self):
+        # Fisher and Fisher * anchor split into per-parameter views, only for the trainable parameters
+        self.penalty = None
+        if self.checkpoint is None or self.fish is None:
+            return
+        fish = self.fish.reshape(-1).to(self.device)
+        fish_anchor = fish * self.checkpoint.reshape(-1).to(self.device)
+        params, fishes, fish_anchors = [], [], []
+        offset = 0
+        for p in self.network.module.parameters():
+            if p.requires_grad:
+                params.append(p)
+                fishes.append(fish[offset : offset + p.numel()].view_as(p))
+                fish_anchors.append(fish_anchor[offset : offset + p.numel()].view_as(p))
+            offset += p.numel()
+        self.penalty = (params, fishes, fish_anchors)
+
+    def add_penalty_grads(self):
+        # grad += 2 * lambda * fish * (param - anchor), accumulated in place after backward
+        params, fishes, fish_anchors = self.penalty
+        indexes = [i for i, p in enumerate(params) if p.grad is not None]
+        grads = [params[i].grad for i in indexes]
+        with torch.no_grad():
+            torch._foreach_addcmul_(grads, [fishes[i] for i in indexes], [params[i] for i in indexes], value=2 * self.ewc_lambda)
+            torch._foreach_add_(grads, [fish_anchors[i] for i in indexes], alpha=-2 * self.ewc_lambda)
   
     def begin_round_server(self):
         self.round += 1
@@ -144,6 +173,7 @@ class EWC(BaseModel):
             self.checkpoint = server_info["checkpoint"].to(self.device)
         if server_info["fisher"] is not None:
             self.fish = server_info["fisher"].to(self.device)
+        self.set_penalty()
         if self.do_linear_probe and not self.done_linear_probe:
             optimizer = self.optimizer_class(self.network.last.parameters(), lr=self.lr, weight_decay=self.wd)
             self.optimizer = self.fabric.setup_optimizers(optimizer)
@@ -167,24 +197,15 @@ class EWC(BaseModel):
         }
     
     def end_task_client(self, train_loader, server_info):
-        fish = torch.zeros_like(self.network.module.get_params())
-        fake_opt = SGD(self.network.module.parameters(), lr=0)
-        for j, data in enumerate(train_loader):
-            inputs, labels = data
-            inputs, labels = inputs.to(self.device), labels.to(self.device).long()
-            inputs = self.test_transform(inputs)
-            for ex, lab in zip(inputs, labels):
-                output = self.network.module(ex.unsqueeze(0))[:, self.cur_offset : self.cur_offset + self.cpt]
-                loss = - F.nll_loss(self.logsoft(output), lab.unsqueeze(0) % self.cpt,
-                                    reduction='none')
-                exp_cond_prob = torch.mean(torch.exp(loss.detach().clone()))
-                loss = torch.mean(loss)
-                loss.backward()
-                fish += exp_cond_prob * self.network.module.get_grads() ** 2
-                fake_opt.zero_grad()
-
-        fake_opt = None
-
+        fish = compute_fisher_diag(
+            self.network.module,
+            train_loader,
+            self.device,
+            transform=self.test_transform,
+            output_slice=(self.cur_offset, self.cur_offset + self.cpt),
+            top_k=self.fisher_top_k,
+            chunk_size=self.fisher_chunk_size,
+        )
         self.fish = fish.cpu()
         return self.get_client_info(train_loader)
 
@@ -192,6 +213,7 @@ class EWC(BaseModel):
         super().end_round_client(dataloader)
         self.optimizer = None
         self.checkpoint = None
+        self.penalty = None
 
     def get_server_info(self):
         dct = {"params": self.network.get_params().data}
@@ -19,6 +19,8 @@ redistributed just like the prototypes. In this way, every client has the same m
 
 @register_model("fedproto")
 class FedProto(FedAvg):
+    checkpoint_attributes = ("global_proto",)
+
     def __init__(
         self,
         fabric,
@@ -39,6 +41,7 @@ class FedProto(FedAvg):
         self.proto = {}
         self.global_proto = {}
         self.ld_reg = ld_reg
+        self.proto_matrix = None  # global prototypes of the current task stacked by class, with the mask of the known ones
 
     def begin_task(self, n_classes_per_task: int):
         res = super().begin_task(n_classes_per_task)
@@ -51,6 +54,19 @@ class FedProto(FedAvg):
         super().begin_round_client(dataloader, server_info)
         if "prototypes" in server_info:
             self.global_proto[self.cur_task] = deepcopy(server_info["prototypes"])
+        self.proto_matrix = self.build_proto_matrix(self.global_proto[self.cur_task])
+
+    def build_proto_matrix(self, prototypes: dict):
+        if len(prototypes) == 0:
+            return None
+        num_rows = max(self.num_classes, max(prototypes) + 1)
+        dim = next(iter(prototypes.values())).shape[-1]
+        matrix = torch.zeros(num_rows, dim, device=self.device)
+        mask = torch.zeros(num_rows, device=self.device)
+        classes = torch.tensor(list(prototypes.keys()), device=self.device)
+        matrix[classes] = torch.stack([proto.float().to(self.device) for proto in prototypes.values()])
+        mask[classes] = 1
+        return matrix, mask
 
     def observe(self, inputs: torch.Tensor, labels: torch.Tensor, update: bool = True) -> float:
         self.optimizer.zero_grad()
@@ -59,13 +75,14 @@ class FedProto(FedAvg):
             feats, outputs = self.network(inputs, penultimate=True)
             outputs = outputs[:, self.cur_offset : self.cur_offset + self.cpt]
             loss_ce = self.loss(outputs, labels - self.cur_offset)
-            classes = torch.unique(labels)
             loss_mse = 0
-            if len(self.global_proto[self.cur_task]) > 0:
-                for class_tensor in classes:
-                    class_ = int(class_tensor.item())
-                    proto_class = feats[labels == class_].mean(0)
-                    loss_mse += F.mse_loss(self.global_proto[self.cur_task][class_], proto_class)
+            if self.proto_matrix is not None:
+                # MSE between the batch prototype and the global one, summed over the classes in the batch
+                proto_matrix, mask = self.proto_matrix
+                sums = torch.zeros_like(proto_matrix).index_add_(0, labels, feats.float())
+                counts = torch.bincount(labels, minlength=proto_matrix.shape[0]).to(proto_matrix.dtype)
+                batch_protos = sums / counts.clamp(min=1).unsqueeze(1)
+                loss_mse = (((batch_protos - proto_matrix) ** 2).mean(1) * mask * (counts > 0)).sum()
             loss = loss_ce + loss_mse * self.ld_reg
         if update:
             self.optimizer.zero_grad()
@@ -77,15 +94,22 @@ class FedProto(FedAvg):
         res = super().end_round_client(dataloader)
         # compute prototypes
         with torch.no_grad():
-            total_feats = torch.tensor([], device=self.device)
-            total_labels = torch.tensor([], device=self.device)
+            sums, counts = None, None
             for inputs, labels in dataloader:
                 feats, _ = self.network(inputs, penultimate=True)
-                total_feats = torch.cat((total_feats, feats))
-                total_labels = torch.cat((total_labels, labels))
-            classes, nums = torch.unique(total_labels, return_counts=True)
-            for class_, num in zip(classes, nums):
-                self.proto[int(class_.item())] = [num.item(), total_feats[total_labels == class_].mean(0)]
+                labels = labels.to(feats.device)
+                num_rows = max(self.num_classes, int(labels.max()) + 1)
+                if sums is None:
+                    sums = torch.zeros(num_rows, feats.shape[-1], device=feats.device)
+                    counts = torch.zeros(num_rows, dtype=torch.int64, device=feats.device)
+                elif num_rows > sums.shape[0]:
+                    sums = F.pad(sums, (0, 0, 0, num_rows - sums.shape[0]))
+                    counts = F.pad(counts, (0, num_rows - counts.shape[0]))
+                sums.index_add_(0, labels, feats.float())
+                counts += torch.bincount(labels, minlength=sums.shape[0])
+            if sums is not None:
+                for class_ in torch.nonzero(counts).view(-1).tolist():
+                    self.proto[class_] = [counts[class_].item(), sums[class_] / counts[class_]]
 
     def get_client_info(self, dataloader: DataLoader):
         client_info = super().get_client_info(dataloader)
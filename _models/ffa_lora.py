@@ -11,7 +11,7 @@ from copy import deepcopy
 from utils.tools import str_to_bool
 import math
 
-from _models.lora import Lora
+from _models.lora import Lora, dense_delta
 
 
 @register_model("ffa_lora")
@@ -30,9 +30,23 @@ class FfaLora(Lora):
         lora_head: str_to_bool = False,
         cl_merge: str = "individual_mean",
         ffa: str_to_bool = True,
+        lowrank_delta: str_to_bool = False,
+        delta_max_rank: int = 0,
     ) -> None:
         super(FfaLora, self).__init__(
-            fabric, network, device, optimizer, lr, wd_reg, avg_type, lora_alpha, r, lora_head, cl_merge
+            fabric,
+            network,
+            device,
+            optimizer,
+            lr,
+            wd_reg,
+            avg_type,
+            lora_alpha,
+            r,
+            lora_head,
+            cl_merge,
+            lowrank_delta=lowrank_delta,
+            delta_max_rank=delta_max_rank,
         )
         for key in self.lora_keys:
             self.cur_A[key] = self.cur_A[key].detach()
@@ -55,7 +69,7 @@ class FfaLora(Lora):
             self.cur_B[key].requires_grad = True
             self.cur_A[key].requires_grad = False
             if self.cur_task > 0 and not "individual" in self.cl_merge:
-                optimization_dict[key] += self.old_delta[key]
+                optimization_dict[key] += dense_delta(self.old_delta[key])
             optimization_dict[key] += self.cur_B[key] @ self.cur_A[key]
         return optimization_dict
 
@@ -6,7 +6,7 @@ from _models import register_model
 from typing import List
 from torch.utils.data import DataLoader
 from _models._utils import BaseModel
-from utils.tools import str_to_bool
+from utils.tools import str_to_bool, compute_fisher_diag
 from _networks.vit_prompt_hgp import VitHGP
 from torch.optim import SGD
 from _networks.vit import VisionTransformer
@@ -14,6 +14,7 @@ from _networks.vit import VisionTransformer
 
 @register_model("fisheravg")
 class FisherAvg(BaseModel):
+    checkpoint_attributes = ("fish",)
 
     def __init__(
         self,
@@ -27,6 +28,8 @@ class FisherAvg(BaseModel):
         avg_type: str = "weighted",
         linear_probe: str_to_bool = False,
         slca: str_to_bool = False,
+        fisher_top_k: int = 0,
+        fisher_chunk_size: int = 16,
     ) -> None:
         if type(network) == VitHGP:
             for n, p in network.named_parameters():
@@ -63,6 +66,8 @@ class FisherAvg(BaseModel):
         self.optimizer_str = optimizer
         self.fish = None
         self.minibatch_size = 16
+        self.fisher_top_k = fisher_top_k
+        self.fisher_chunk_size = fisher_chunk_size if fisher_chunk_size > 0 else None
 
     def observe(self, inputs: torch.Tensor, labels: torch.Tensor, update: bool = True) -> float:
         aug_inputs = self.augment(inputs)
@@ -134,22 +139,14 @@ class FisherAvg(BaseModel):
         super().end_round_client(dataloader)
         self.optimizer = None
         
-        fish = torch.zeros_like(self.network.module.get_params())
-        fake_opt = SGD(self.network.module.parameters(), lr=0)
-        for j, data in enumerate(dataloader):
-            inputs, labels = data
-            inputs, labels = inputs.to(self.device), labels.to(self.device).long()
-            for ex, lab in zip(inputs, labels):
-                output = self.network.module(ex.unsqueeze(0))[:, self.cur_offset : self.cur_offset + self.cpt]
-                loss = - F.nll_loss(self.logsoft(output), lab.unsqueeze(0) % self.cpt,
-                                    reduction='none')
-                exp_cond_prob = torch.mean(torch.exp(loss.detach().clone()))
-                loss = torch.mean(loss)
-                loss.backward()
-                fish += exp_cond_prob * self.network.module.get_grads() ** 2
-                fake_opt.zero_grad()
-
-        fake_opt = None
+        fish = compute_fisher_diag(
+            self.network.module,
+            dataloader,
+            self.device,
+            output_slice=(self.cur_offset, self.cur_offset + self.cpt),
+            top_k=self.fisher_top_k,
+            chunk_size=self.fisher_chunk_size,
+        )
         self.fish = fish.cpu()
 
     def get_server_info(self):
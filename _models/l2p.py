@@ -14,6 +14,8 @@ import math
 
 @register_model("l2p")
 class L2P(BaseModel):
+    checkpoint_attributes = ("mogs_per_task",)
+
     def __init__(
         self,
         fabric,
@@ -31,8 +31,88 @@ def merge_AB(A, B, lora_ind):
     return T(zero_pad(delta_w, lora_ind))
 
 
+class LowRankDelta:
+    """Sum of low-rank updates kept as the concatenated factors B (d_out x k) and A (k x d_in), i.e. B @ A.
+
+    The dense matrix is only built when requested and cached, the cache is never copied or pickled. With max_rank > 0
+    the factors are re-compressed to max_rank with a truncated SVD whenever k exceeds it.
+    """
+
+    def __init__(self, B: torch.Tensor, A: torch.Tensor, max_rank: int = 0):
+        self.B = B
+        self.A = A
+        self.max_rank = max_rank
+        self.requires_grad = False
+        self._dense = None
+
+    @classmethod
+    def zeros(cls, d_out: int, d_in: int, max_rank: int = 0, device=None):
+        return cls(torch.zeros(d_out, 0, device=device), torch.zeros(0, d_in, device=device), max_rank)
+
+    @property
+    def shape(self) -> torch.Size:
+        return torch.Size((self.B.shape[0], self.A.shape[1]))
+
+    @property
+    def rank(self) -> int:
+        return self.B.shape[1]
+
+    def dense(self) -> torch.Tensor:
+        if self._dense is None:
+            self._dense = self.B @ self.A
+        return self._dense
+
+    def add_(self, B: torch.Tensor, A: torch.Tensor, weight: float = 1.0):
+        self.B = torch.cat([self.B, B.detach().to(self.B.device, self.B.dtype) * weight], dim=1)
+        self.A = torch.cat([self.A, A.detach().to(self.A.device, self.A.dtype)], dim=0)
+        if self.max_rank > 0 and self.rank > self.max_rank:
+            self.compress(self.max_rank)
+        self._dense = None
+        return self
+
+    def mul_(self, value: float):
+        if value == 0:
+            self.B, self.A = self.B[:, :0], self.A[:0]
+        else:
+            self.B = self.B * value
+        self._dense = None
+        return self
+
+    def compress(self, rank: int):
+        # SVD of B @ A through the QR factorizations of B and A^T, only k x k matrices are decomposed
+        dtype = self.B.dtype
+        Q_B, R_B = torch.linalg.qr(self.B.float())
+        Q_A, R_A = torch.linalg.qr(self.A.T.float())
+        U, S, Vh = torch.linalg.svd(R_B @ R_A.T)
+        self.B = ((Q_B @ U[:, :rank]) * S[:rank]).to(dtype)
+        self.A = (Vh[:rank] @ Q_A.T).to(dtype)
+        self._dense = None
+        return self
+
+    def detach(self):
+        return self
+
+    def to(self, device):
+        self.B, self.A = self.B.to(device), self.A.to(device)
+        if self._dense is not None:
+            self._dense = self._dense.to(device)
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_dense"] = None
+        return state
+
+
+def dense_delta(delta) -> torch.Tensor:
+    return delta.dense() if isinstance(delta, LowRankDelta) else delta
+
+
 @register_model("lora")
 class Lora(BaseModel):
+    checkpoint_attributes = ("cur_A", "cur_B", "old_delta", "head", "old_tasks_A", "old_tasks_B")
+    eval_attributes = ("optimization_dict",)
+
     def __init__(
         self,
         fabric,
@@ -47,9 +127,14 @@ class Lora(BaseModel):
         r: int = 16,
         lora_head: str_to_bool = False,
         cl_merge: str = "individual_mean",
+        lowrank_delta: str_to_bool = False,
+        delta_max_rank: int = 0,
     ) -> None:
         # for LoRA, we keep the mean of the LoRA modules of the old tasks
         super().__init__(fabric, network, device, optimizer, lr, wd_reg)
+        # old tasks delta as stacked LoRA factors (re-compressed to delta_max_rank if > 0) instead of dense matrices
+        self.lowrank_delta = lowrank_delta
+        self.delta_max_rank = delta_max_rank
         self.lora_alpha = lora_alpha
         self.r = r
         self.cl_merge = cl_merge
@@ -98,9 +183,14 @@ class Lora(BaseModel):
             ):
                 self.lora_keys.append(name)
                 self.lora_params[name] = {name: [param.shape[1], param.shape[0]]}
-                self.old_delta[name] = nn.Parameter(
-                    torch.zeros(param.shape[0], param.shape[1]), requires_grad=False
-                ).to(self.device)
+                if self.lowrank_delta:
+                    self.old_delta[name] = LowRankDelta.zeros(
+                        param.shape[0], param.shape[1], self.delta_max_rank, device=self.device
+                    )
+                else:
+                    self.old_delta[name] = nn.Parameter(
+                        torch.zeros(param.shape[0], param.shape[1]), requires_grad=False
+                    ).to(self.device)
                 self.cur_B[name] = nn.Parameter(torch.zeros(param.shape[0], r), requires_grad=True).to(self.device)
                 self.cur_A[name] = nn.Parameter(torch.zeros(r, param.shape[1]), requires_grad=True).to(self.device)
                 nn.init.kaiming_uniform_(self.cur_A[name], a=math.sqrt(5))
@@ -129,12 +219,12 @@ class Lora(BaseModel):
         if "run_sum" in self.cl_merge:
             for key in self.lora_keys:
                 if self.cur_task > 0:
-                    self.optimization_dict[key] += self.old_delta[key]
+                    self.optimization_dict[key] += dense_delta(self.old_delta[key])
                 self.optimization_dict[key] += self.cur_B[key] @ self.cur_A[key]
         elif "run_mean" in self.cl_merge:
             for key in self.lora_keys:
                 if self.cur_task > 0:
-                    tmp = (self.old_delta[key] * self.cur_task) + self.cur_B[key] @ self.cur_A[key]
+                    tmp = (dense_delta(self.old_delta[key]) * self.cur_task) + self.cur_B[key] @ self.cur_A[key]
                     self.optimization_dict[key] += tmp / (self.cur_task + 1)
                 else:
                     self.optimization_dict[key] += self.cur_B[key] @ self.cur_A[key]
@@ -142,14 +232,14 @@ class Lora(BaseModel):
             if "sum" in self.cl_merge:
                 for key in self.lora_keys:
                     if self.cur_task > 0:
-                        tmp = (self.old_delta[key] * self.cur_task) + self.cur_B[key] @ self.cur_A[key]
+                        tmp = (dense_delta(self.old_delta[key]) * self.cur_task) + self.cur_B[key] @ self.cur_A[key]
                         self.optimization_dict[key] += tmp
                     else:
                         self.optimization_dict[key] += self.cur_B[key] @ self.cur_A[key]
             elif "mean" in self.cl_merge:
                 for key in self.lora_keys:
                     if self.cur_task > 0:
-                        tmp = (self.old_delta[key] * self.cur_task) + self.cur_B[key].detach() @ self.cur_A[
+                        tmp = (dense_delta(self.old_delta[key]) * self.cur_task) + self.cur_B[key].detach() @ self.cur_A[
                             key
                         ].detach()
                         self.optimization_dict[key] += tmp / (self.cur_task + 1)
@@ -203,7 +293,7 @@ class Lora(BaseModel):
             self.cur_B[key].requires_grad = True
             self.cur_A[key].requires_grad = True
             if self.cur_task > 0 and not "individual" in self.cl_merge:
-                optimization_dict[key] += self.old_delta[key]
+                optimization_dict[key] += dense_delta(self.old_delta[key])
             optimization_dict[key] += self.cur_B[key] @ self.cur_A[key]
         return optimization_dict
 
@@ -213,7 +303,14 @@ class Lora(BaseModel):
     def begin_task(self, n_classes_per_task: int):
         super().begin_task(n_classes_per_task)
         if self.cur_task > 0:
-            if self.cl_merge == "run_sum":
+            if self.lowrank_delta and self.cl_merge == "run_sum":
+                for key in self.lora_keys:
+                    self.old_delta[key].add_(self.cur_B[key], self.cur_A[key])
+            elif self.lowrank_delta and (self.cl_merge == "run_mean" or "individual" in self.cl_merge):
+                for key in self.lora_keys:
+                    self.old_delta[key].mul_((self.cur_task - 1) / self.cur_task)
+                    self.old_delta[key].add_(self.cur_B[key], self.cur_A[key], weight=1 / self.cur_task)
+            elif self.cl_merge == "run_sum":
                 for key in self.lora_keys:
                     self.old_delta[key] += self.cur_B[key].detach() @ self.cur_A[key].detach()
             elif self.cl_merge == "run_mean" or "individual" in self.cl_merge:
@@ -34,6 +34,9 @@ def merge_AB(A, B, lora_ind):
 
 @register_model("lora_pre")
 class Lora(BaseModel):
+    checkpoint_attributes = ("cur_A", "cur_B", "old_delta", "head", "old_tasks_A", "old_tasks_B")
+    eval_attributes = ("optimization_dict",)
+
     def __init__(
         self,
         fabric,
@@ -4,7 +4,7 @@ from torch.nn import functional as F
 from torch.utils.data import DataLoader
 from _models import register_model
 from typing import List
-from _models._utils import BaseModel
+from _models._utils import BaseModel, solve_gram_systems, unpack_gram
 from _networks.vit import VisionTransformer as Vit
 from torch.func import functional_call
 from copy import deepcopy
@@ -45,6 +45,9 @@ class LoRM(Lora, RegMean):
         train_bias: str = "all",
         train_matrix: str = "alt",
         regmean_rounds: int = 1,
+        gram_acc_dtype: str = "",
+        gram_pack: str_to_bool = False,
+        gram_comm_dtype: str = "",
     ) -> None:
         self.is_server = False
         self.regmean_rounds = regmean_rounds
@@ -82,7 +85,10 @@ class LoRM(Lora, RegMean):
             only_square,
             train_bias,
             clip_grad,
-            regmean_rounds
+            regmean_rounds,
+            gram_acc_dtype=gram_acc_dtype,
+            gram_pack=gram_pack,
+            gram_comm_dtype=gram_comm_dtype,
         )
         self.middle_names = {}
         for name in self.gram_modules:
@@ -267,6 +273,7 @@ class LoRM(Lora, RegMean):
             else:
                 # eps = 5e-7
                 keys = list(self.network.state_dict().keys())
+                systems = {}  # X G = E systems of the regmean layers, solved together once all are built
                 if self.cur_train_matrix == "A":
                     # merge As, Bs are all the same
                     cl_A = [client["cur_A"] for client in client_info]  # list of A matrices for all clients
@@ -276,7 +283,7 @@ class LoRM(Lora, RegMean):
                             # print(key)
                             for i in range(len(cl_A)):
                                 cl_A[i][key] = cl_A[i][key].to(self.device).to(dtype)
-                                client_info[i]["grams"][name] = client_info[i]["grams"][name].to(self.device).to(dtype)
+                                client_info[i]["grams"][name] = unpack_gram(client_info[i]["grams"][name], dtype).to(self.device)
                             B = self.cur_B[key].to(self.device).to(dtype)
                             E = torch.stack(
                                 [
@@ -288,12 +295,11 @@ class LoRM(Lora, RegMean):
                             G = torch.stack(
                                 [client["grams"][name].to(self.device).to(dtype) for client in client_info]
                             ).sum(0)
-                            A = E @ torch.pinverse(G)  # A
-                            self.cur_A[key] = A.to(torch.float32).to("cpu")
+                            systems[key] = (E.to("cpu"), G.to("cpu"))  # A = E G^-1
                             for i in range(len(cl_A)):
                                 cl_A[i][key] = cl_A[i][key].to("cpu")
                                 client_info[i]["grams"][name] = client_info[i]["grams"][name].to("cpu")
-                            del E, G, A, B
+                            del E, G, B
                             if torch.cuda.memory_reserved() / total_mem > 0.8:
                                 torch.cuda.empty_cache()
                             # gc.collect()
@@ -314,7 +320,7 @@ class LoRM(Lora, RegMean):
                             # print(key)
                             for i in range(len(cl_B)):
                                 cl_B[i][key] = cl_B[i][key].to(self.device).to(dtype)
-                                client_info[i]["grams"][name] = client_info[i]["grams"][name].to(self.device).to(dtype)
+                                client_info[i]["grams"][name] = unpack_gram(client_info[i]["grams"][name], dtype).to(self.device)
                             A = self.cur_A[key].to(self.device).to(dtype)
                             E2 = torch.stack(
                                 [
@@ -323,19 +329,18 @@ class LoRM(Lora, RegMean):
                                     for B_, client in zip(cl_B, client_info)
                                 ]
                             ).sum(0)
-                            G_inv = torch.pinverse(
+                            G = (
                                 A
                                 @ torch.stack(
                                     [client["grams"][name].to(self.device).to(dtype) for client in client_info]
                                 ).sum(0)
                                 @ A.T
                             )
-                            B = E2 @ A.T @ G_inv  # B
-                            self.cur_B[key] = B.to(torch.float32).to("cpu")
+                            systems[key] = ((E2 @ A.T).to("cpu"), G.to("cpu"))  # B = E2 A^T (A G A^T)^-1
                             for i in range(len(cl_B)):
                                 cl_B[i][key] = cl_B[i][key].to("cpu")
                                 client_info[i]["grams"][name] = client_info[i]["grams"][name].to("cpu")
-                            del E2, G_inv, A, B
+                            del E2, G, A
                             # gc.collect()
                             # print(f"reserved memory: {torch.cuda.memory_reserved()}\tallocated memory: {torch.cuda.memory_allocated()}")
                             if torch.cuda.memory_reserved() / total_mem > 0.8:
@@ -349,34 +354,21 @@ class LoRM(Lora, RegMean):
                             )
                     # bt btb eg
                     # eg ata at
+                merged = self.cur_A if self.cur_train_matrix == "A" else self.cur_B
+                for key, X in solve_gram_systems(systems, device=self.device).items():
+                    merged[key] = X.to(torch.float32)
+                del systems
             # end = time()
             torch.cuda.empty_cache()
             # print(f"Time for merging: {end - start} seconds")
-            keys = list(self.network.state_dict().keys())
+            # head parameters: regmean on the Linear layer and fedavg on the bias, from the running sums
+            for client in client_info:
+                if "state_dict" in client:  # not streamed through receive_client_info
+                    self.accumulate_regmean(
+                        client["state_dict"], client["grams"], client["num_train_samples"], self.head_state_keys()
+                    )
             sd = self.network.state_dict()
-            for key in keys:
-                # head parameters
-                if "head" in key:
-                    if self.middle_names.get(key) is not None and "head" in key:  # regmean on Linear layer
-                        name = self.middle_names[key]
-                        sd[key] = (
-                            torch.stack(
-                                [
-                                    client["state_dict"][key].to(dtype) @ client["grams"][name].to(dtype)
-                                    for client in client_info
-                                ]
-                            ).sum(0)
-                            @ torch.inverse(
-                                torch.stack([client["grams"][name].to(dtype) for client in client_info]).sum(0)
-                            )
-                        ).to(torch.float32)
-                    else:  # fedavg bias
-                        sd[key] = torch.stack(
-                            [
-                                client["state_dict"][key] * norm_weight
-                                for client, norm_weight in zip(client_info, norm_weights)
-                            ]
-                        ).sum(0)
+            sd.update(self.solve_regmean())
             # end2 = time()
             torch.cuda.empty_cache()
             del cl_B, cl_A, client_info
@@ -397,6 +389,19 @@ class LoRM(Lora, RegMean):
             # end3 = time()
             # print(f"Time fir the rest: {end3 - end2} seconds")
 
+    def head_state_keys(self) -> List[str]:
+        return [key for key in self.network.state_dict().keys() if "head" in key]
+
+    def receive_client_info(self, client_info: dict) -> dict:
+        # the head is merged from running sums, so its Gram matrices and the state_dict are dropped on arrival
+        self.accumulate_regmean(
+            client_info["state_dict"], client_info["grams"], client_info["num_train_samples"], self.head_state_keys()
+        )
+        client_info = dict(client_info)
+        del client_info["state_dict"]
+        client_info["grams"] = {name: gram for name, gram in client_info["grams"].items() if "head" not in name}
+        return client_info
+
     def get_client_info(self, dataloader: DataLoader):
         for key in self.lora_keys:
             self.cur_B[key] = self.cur_B[key].detach()
@@ -411,7 +416,7 @@ class LoRM(Lora, RegMean):
                 client_info["head"] = self.network.head.state_dict()
             else:
                 client_info["head"] = self.network.model.head.state_dict()
-        client_info["grams"] = self.features
+        client_info["grams"] = self.ship_grams(self.features) if self.gram_pack else self.features
         client_info["state_dict"] = self.network.state_dict()
         return client_info
 
@@ -431,14 +436,14 @@ class LoRM(Lora, RegMean):
         RegMean.end_round_client(self, dataloader)
         self.gram_modules = real_modules
         self.to("cpu", only_trainable=False)
-        return {"grams": self.features}
+        return {"grams": self.ship_grams(self.features) if self.gram_pack else self.features}
 
     def end_task_server(self, client_info: List[dict] = None):
         with torch.no_grad():
             gram_modules = [mod for mod in self.gram_modules if "head" not in mod]
             grams = {}
             for module in gram_modules:
-                grams[module] = torch.stack([client_info[i]["grams"][module] for i in range(len(client_info))]).sum(0)
+                grams[module] = sum(unpack_gram(client_info[i]["grams"][module]) for i in range(len(client_info)))
             optimization_dict = deepcopy(self.network.state_dict())
             if getattr(self, "run_weights_gram", None) is None:
                 self.run_weights_gram = {
@@ -467,9 +472,10 @@ class LoRM(Lora, RegMean):
                     else:
                         self.run_gram[key] = self.run_gram[key].to(self.device)
                         self.run_gram[key] += gram
-                    if self.cur_task > 0:
-                        optimization_dict[key] += self.run_weights_gram[key] @ torch.pinverse(self.run_gram[key])
             if self.cur_task > 0:
+                systems = {key: (self.run_weights_gram[key], self.run_gram[key]) for key in self.run_gram}
+                for key, X in solve_gram_systems(systems).items():
+                    optimization_dict[key] += X
                 self.optimization_dict = optimization_dict
 
     def set_optimization_cur_task(self, fabric=True):
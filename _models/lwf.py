@@ -5,7 +5,7 @@ from torch.nn import functional as F
 from _models import register_model
 from typing import List
 from torch.utils.data import DataLoader
-from _models._utils import BaseModel
+from _models._utils import BaseModel, SharedTeacher
 from utils.tools import str_to_bool
 from _networks.vit_prompt_hgp import VitHGP
 from _networks.vit import VisionTransformer
@@ -26,7 +26,9 @@ class LwF(BaseModel):
         linear_probe: str_to_bool = False,
         slca: str_to_bool = False,
         alpha: float = 0.5,
-        softmax_temp: float = 2
+        softmax_temp: float = 2,
+        teacher_cache: str_to_bool = False,
+        teacher_cache_size: int = 50000,
     ) -> None:
         if type(network) == VitHGP:
             for n, p in network.named_parameters():
@@ -63,6 +65,8 @@ class LwF(BaseModel):
         self.logsoft = torch.nn.LogSoftmax(dim=1)
         self.checkpoint = None
         self.optimizer_str = optimizer
+        self.teacher_cache = teacher_cache  # teacher logits computed once per sample on the un-augmented inputs
+        self.teacher = SharedTeacher.for_run(fabric, teacher_cache_size)  # shared by all the clients of the run
     
     @staticmethod
     def modified_kl_div(old, new):
@@ -81,7 +85,11 @@ class LwF(BaseModel):
             loss = self.loss(outputs, labels - self.cur_offset)
             if self.cur_task > 0 and self.checkpoint is not None:
                 with torch.no_grad():
-                    old_logits = self.checkpoint(aug_inputs)[:, self.cur_offset : self.cur_offset + self.cpt]
+                    if self.teacher_cache:
+                        old_logits = self.teacher.outputs(inputs, lambda x: self.checkpoint(self.test_transform(x)))
+                    else:
+                        old_logits = self.checkpoint(aug_inputs)
+                    old_logits = old_logits[:, self.cur_offset : self.cur_offset + self.cpt]
                 loss += self.alpha * self.modified_kl_div(self.smooth(self.soft(old_logits[:, :self.cur_offset + self.cpt]).to(self.device), 2, 1),
                                                         self.smooth(self.soft(outputs[:, :self.cur_offset + self.cpt]), 2, 1))
         if update:
@@ -128,13 +136,26 @@ class LwF(BaseModel):
         self.checkpoint = deepcopy(self.network.eval())
         self.network.train(train_status)
 
-    def begin_round_client(self, dataloader: DataLoader, server_info: dict):
-        self.network.set_params(server_info["params"])
-        if server_info["checkpoint"] is not None:
+    def get_checkpoint_state(self) -> dict:
+        # the teacher is saved as its parameters and rebuilt from the network when loaded
+        state = super().get_checkpoint_state()
+        state["checkpoint"] = None if self.checkpoint is None else self.checkpoint.get_params().detach().cpu()
+        return state
+
+    def set_checkpoint_state(self, state: dict) -> None:
+        state = dict(state)
+        params = state.pop("checkpoint", None)
+        super().set_checkpoint_state(state)
+        if params is not None:
             train_status = self.network.training
             self.checkpoint = deepcopy(self.network.eval())
             self.network.train(train_status)
-            self.checkpoint.set_params(server_info["checkpoint"])
+            self.checkpoint.set_params(params.to(self.device))
+
+    def begin_round_client(self, dataloader: DataLoader, server_info: dict):
+        self.network.set_params(server_info["params"])
+        if server_info["checkpoint"] is not None:
+            self.checkpoint = self.teacher.load(self.network, server_info["checkpoint"], task=self.cur_task)
         if self.do_linear_probe and not self.done_linear_probe:
             optimizer = self.optimizer_class(self.network.last.parameters(), lr=self.lr, weight_decay=self.wd)
             self.optimizer = self.fabric.setup_optimizers(optimizer)
@@ -45,21 +45,37 @@ class _LoRA_qkv_timm(nn.Module):
         self.dim = qkv.in_features
         self.w_identity = torch.eye(qkv.in_features)
         self.lora_id = 0
+        for name in ["q", "v"]:
+            self.register_buffer(f"old_a_{name}", None, persistent=False)
+            self.register_buffer(f"old_b_{name}", None, persistent=False)
     
     def change_lora(self, num):
         self.lora_id = num
+        self.fold_old_loras()
+
+    @torch.no_grad()
+    def fold_old_loras(self):
+        # the frozen LoRAs of the previous tasks are stacked into a single low-rank delta (B_old @ A_old),
+        # or collapsed into a dense one when that is cheaper, so that the forward cost does not grow with the tasks
+        for name in ["q", "v"]:
+            old_a, old_b = None, None
+            if self.lora_id > 0:
+                old_a = torch.cat([getattr(self, f"linear_a_{name}_{i}").weight for i in range(self.lora_id)])
+                old_b = torch.cat([getattr(self, f"linear_b_{name}_{i}").weight for i in range(self.lora_id)], dim=1)
+                if 2 * old_a.shape[0] >= self.dim:
+                    old_a, old_b = None, old_b @ old_a
+            setattr(self, f"old_a_{name}", old_a)
+            setattr(self, f"old_b_{name}", old_b)
+
+    @staticmethod
+    def old_delta(x, old_a, old_b):
+        return F.linear(x, old_b) if old_a is None else F.linear(F.linear(x, old_a), old_b)
 
     def forward(self, x):
         qkv = self.qkv(x)  # B,N,3*org_C
-        for i in range(self.lora_id):
-            linear_a_q = getattr(self, f'linear_a_q_{i}')
-            linear_b_q = getattr(self, f'linear_b_q_{i}')
-            linear_a_v = getattr(self, f'linear_a_v_{i}')
-            linear_b_v = getattr(self, f'linear_b_v_{i}')
-            new_q = linear_b_q(linear_a_q(x))
-            new_v = linear_b_v(linear_a_v(x))
-            qkv[:, :, : self.dim] += new_q
-            qkv[:, :, -self.dim :] += new_v
+        if self.old_b_q is not None:
+            qkv[:, :, : self.dim] += self.old_delta(x, self.old_a_q, self.old_b_q)
+            qkv[:, :, -self.dim :] += self.old_delta(x, self.old_a_v, self.old_b_v)
         linear_a_q = getattr(self, f'linear_a_q_{self.lora_id}')
         linear_b_q = getattr(self, f'linear_b_q_{self.lora_id}')
         linear_a_v = getattr(self, f'linear_a_v_{self.lora_id}')
@@ -72,6 +88,8 @@ class _LoRA_qkv_timm(nn.Module):
 
 @register_model("pilora3")
 class PiLora(BaseModel):
+    checkpoint_attributes = ("class_protos",)
+
     def __init__(
         self,
         fabric,
@@ -144,12 +162,33 @@ class PiLora(BaseModel):
         self.avg_type = avg_type
         self.cur_round = 0
         self.average_features = None
+        self.protos_cache = None
         #torch.set_float32_matmul_precision("high")
 
+    def proto_rows(self, task: int) -> range:
+        # temporal fix to make it work with cars, will need a better fix later on, but it works for now
+        return range(len(self.class_protos[task]) if task < self.num_tasks - 1 else self.cpt)
+
+    def get_protos(self) -> torch.Tensor:
+        # only the prototypes of the current task are trained, the others are concatenated once and cached
+        # until class_protos is replaced or the task changes
+        cache = self.protos_cache
+        if cache is None or cache[0] is not self.class_protos or cache[1] != self.cur_task:
+            with torch.no_grad():
+                prefix = [self.class_protos[t][i].detach() for t in range(self.cur_task) for i in self.proto_rows(t)]
+                suffix = [self.class_protos[t][i].detach() for t in range(self.cur_task + 1, self.num_tasks) for i in self.proto_rows(t)]
+                prefix = torch.cat(prefix) if len(prefix) > 0 else None
+                suffix = torch.cat(suffix) if len(suffix) > 0 else None
+            cache = (self.class_protos, self.cur_task, prefix, suffix)
+            self.protos_cache = cache
+        current = torch.cat([self.class_protos[self.cur_task][i] for i in self.proto_rows(self.cur_task)])
+        protos = [p.to(current.device) for p in (cache[2], current, cache[3]) if p is not None]
+        return torch.cat(protos) if len(protos) > 1 else current
+
     def forward(self, x, fabric=True):
         #prelogits, _ = self.network(x, penultimate=True)
         prelogits = self.network.forward(x, prelogits=True)
-        protos = torch.cat([self.class_protos[t][i] for t in range(self.num_tasks) for i in range(len(self.class_protos[t]) if t < self.num_tasks - 1 else self.cpt)])
+        protos = self.get_protos()
         score = F.softmax(-torch.cdist(prelogits, protos, p=2), dim=1)
         return score
 
@@ -181,8 +220,7 @@ class PiLora(BaseModel):
             self.classes[labs % self.cpt] += nums
             loss = 0
             # protos = torch.cat([self.class_protos[t][i] for t in range(self.num_tasks) for i in range(self.cpt)])
-            # temporal fix to make it work with cars, will need a better fix later on, but it works for now
-            protos = torch.cat([self.class_protos[t][i] for t in range(self.num_tasks) for i in range(len(self.class_protos[t]) if t < self.num_tasks - 1 else self.cpt)])
+            protos = self.get_protos()
             distances = prelogits.pow(2).sum(1, keepdim=True) + protos.pow(2).sum(1, keepdim=True).T - 2 *(torch.matmul(prelogits, protos.T))
             distances /= 768
             distances = distances.sqrt()
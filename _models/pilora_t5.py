@@ -72,6 +72,8 @@ class _LoRA_qkv_timm(nn.Module):
 
 @register_model("pilora_t5")
 class PiLora(BaseModel):
+    checkpoint_attributes = ("class_protos", "cur_A", "cur_B", "old_A", "old_B", "old_delta")
+
     def __init__(
         self,
         fabric,
@@ -138,6 +140,7 @@ class PiLora(BaseModel):
         nn.init.kaiming_uniform_(self.cur_A['model.encoder.block.0.layer.0.SelfAttention.v.weight'], a=math.sqrt(5))
         self.old_A = {}
         self.old_B = {}
+        self.old_delta = {}  # sum of old_B @ old_A over the previous tasks, computed when a task begins
         self.class_protos = {}
         self.cur_task = -1
         self.num_tasks = num
@@ -147,26 +150,54 @@ class PiLora(BaseModel):
         self.avg_type = avg_type
         self.cur_round = 0
         self.average_features = None
+        self.protos_cache = None
         #torch.set_float32_matmul_precision("high")
 
+    @torch.no_grad()
+    def fold_old_loras(self):
+        self.old_delta = {}
+        for key in self.lora_keys:
+            if self.cur_task > 0:
+                self.old_delta[key] = sum(self.old_B[i][key].detach() @ self.old_A[i][key].detach() for i in range(self.cur_task))
+
     def set_optimization_dict(self, optimization_dict = None):
+        # only the LoRA targets are replaced, the other entries are the (shared) tensors of the state dict
         if optimization_dict is None:
-            optimization_dict = deepcopy(self.network.state_dict())
-        for i in range(self.cur_task):
-            for key in self.lora_keys:
-                optimization_dict[key] += self.old_B[i][key] @ self.old_A[i][key]
-        optimization_dict['model.encoder.block.0.layer.0.SelfAttention.q.weight'] += self.cur_B['model.encoder.block.0.layer.0.SelfAttention.q.weight'] @ self.cur_A['model.encoder.block.0.layer.0.SelfAttention.q.weight']
-        #optimization_dict['model.encoder.block.0.layer.0.SelfAttention.k.weight'] += self.cur_B['model.encoder.block.0.layer.0.SelfAttention.k.weight'] @ self.cur_A['model.encoder.block.0.layer.0.SelfAttention.k.weight']
-        optimization_dict['model.encoder.block.0.layer.0.SelfAttention.v.weight'] += self.cur_B['model.encoder.block.0.layer.0.SelfAttention.v.weight'] @ self.cur_A['model.encoder.block.0.layer.0.SelfAttention.v.weight']
+            optimization_dict = dict(self.network.state_dict())
+        for key in self.lora_keys:
+            weight = optimization_dict[key]
+            if key in self.old_delta:
+                weight = weight + self.old_delta[key].to(weight.device)
+            optimization_dict[key] = weight + self.cur_B[key] @ self.cur_A[key]
         return optimization_dict 
 
+    def proto_rows(self, task: int) -> range:
+        # temporal fix to make it work with cars, will need a better fix later on, but it works for now
+        return range(len(self.class_protos[task]) if task < self.num_tasks - 1 else self.cpt)
+
+    def get_protos(self) -> torch.Tensor:
+        # only the prototypes of the current task are trained, the others are concatenated once and cached
+        # until class_protos is replaced or the task changes
+        cache = self.protos_cache
+        if cache is None or cache[0] is not self.class_protos or cache[1] != self.cur_task:
+            with torch.no_grad():
+                prefix = [self.class_protos[t][i].detach() for t in range(self.cur_task) for i in self.proto_rows(t)]
+                suffix = [self.class_protos[t][i].detach() for t in range(self.cur_task + 1, self.num_tasks) for i in self.proto_rows(t)]
+                prefix = torch.cat(prefix) if len(prefix) > 0 else None
+                suffix = torch.cat(suffix) if len(suffix) > 0 else None
+            cache = (self.class_protos, self.cur_task, prefix, suffix)
+            self.protos_cache = cache
+        current = torch.cat([self.class_protos[self.cur_task][i] for i in self.proto_rows(self.cur_task)])
+        protos = [p.to(current.device) for p in (cache[2], current, cache[3]) if p is not None]
+        return torch.cat(protos) if len(protos) > 1 else current
+
 
     def forward(self, x, fabric=True):
         #prelogits, _ = self.network(x, penultimate=True)
         opt_dict = self.set_optimization_dict()
         prelogits = functional_call(self.network, opt_dict, x, kwargs={'prelogits' : True})['last_hidden_state'][:, 0]
         #prelogits = self.network.forward(x, prelogits=True)
-        protos = torch.cat([self.class_protos[t][i] for t in range(self.num_tasks) for i in range(len(self.class_protos[t]) if t < self.num_tasks - 1 else self.cpt)])
+        protos = self.get_protos()
         score = F.softmax(-torch.cdist(prelogits, protos, p=2), dim=1)
         return score
 
@@ -209,8 +240,7 @@ class PiLora(BaseModel):
             self.classes[labs % self.cpt] += nums
             loss = 0
             # protos = torch.cat([self.class_protos[t][i] for t in range(self.num_tasks) for i in range(self.cpt)])
-            # temporal fix to make it work with cars, will need a better fix later on, but it works for now
-            protos = torch.cat([self.class_protos[t][i] for t in range(self.num_tasks) for i in range(len(self.class_protos[t]) if t < self.num_tasks - 1 else self.cpt)])
+            protos = self.get_protos()
             distances = prelogits.pow(2).sum(1, keepdim=True) + protos.pow(2).sum(1, keepdim=True).T - 2 *(torch.matmul(prelogits, protos.T))
             distances /= 512
             distances = distances.sqrt()
@@ -264,6 +294,7 @@ class PiLora(BaseModel):
                 self.cur_A[key] = nn.Parameter(torch.tensor(torch.ones((self.r, self.dim)), device = self.device, requires_grad=True))
                 nn.init.kaiming_uniform_(self.cur_A[key], a=math.sqrt(5))
                 self.cur_B[key] = nn.Parameter(torch.tensor(torch.zeros((self.dim, self.r)), device = self.device,  requires_grad=True))
+        self.fold_old_loras()
         #self.class_protos[self.cur_task] = nn.ParameterList([nn.Parameter(0.1*torch.randn(1, 512), requires_grad=True).to(self.device) for i in range(self.cpt)])
         self.cur_round = 0
         self.average_features = torch.zeros(self.cpt, 512).to(self.device)
@@ -4,7 +4,7 @@ from torch.nn import functional as F
 from torch.utils.data import DataLoader
 from _models import register_model
 from typing import List
-from _models._utils import BaseModel
+from _models._utils import BaseModel, solve_gram_systems, pack_gram, unpack_gram, regularize_gram_
 from _networks.vit import VisionTransformer as Vit
 from torch.func import functional_call
 from copy import deepcopy
@@ -14,6 +14,14 @@ from _models.lora import Lora, merge_AB, zero_pad
 from tqdm import tqdm
 
 
+def str_to_dtype(dtype: str) -> torch.dtype:
+    return (
+        torch.float32
+        if dtype == "32"
+        else torch.float16 if dtype == "16" else torch.bfloat16 if dtype == "b16" else torch.float64
+    )
+
+
 @register_model("regmean")
 class RegMean(BaseModel):
 
@@ -37,6 +45,9 @@ class RegMean(BaseModel):
         clip_grad: str_to_bool = False,
         linear_probe_epochs: int = 0,
         regmean_rounds: int = 1,
+        gram_acc_dtype: str = "",
+        gram_pack: str_to_bool = False,
+        gram_comm_dtype: str = "",
     ) -> None:
         self.reg_dtype_64 = reg_dtype_64
         self.optimizer_str = optimizer
@@ -64,11 +75,11 @@ class RegMean(BaseModel):
         self.alpha_regmean = [alpha_regmean_backbone, alpha_regmean_head]
         self.gram_modules = []
         self.middle_names = {}  # conversion from state_dict() names to the names of the modules
-        self.gram_dtype = (
-            torch.float32
-            if gram_dtype == "32"
-            else torch.float16 if gram_dtype == "16" else torch.bfloat16 if gram_dtype == "b16" else torch.float64
-        )
+        self.gram_dtype = str_to_dtype(gram_dtype)
+        # precision of the running sums (defaults to gram_dtype) and of the shipped upper triangles
+        self.gram_acc_dtype = str_to_dtype(gram_acc_dtype) if gram_acc_dtype else self.gram_dtype
+        self.gram_pack = gram_pack
+        self.gram_comm_dtype = str_to_dtype(gram_comm_dtype) if gram_comm_dtype else None
         if regmean_all:
             if "t5" in str(type(network)).lower():
                 for name, module in self.network.named_modules():
@@ -109,6 +120,7 @@ class RegMean(BaseModel):
         self.features = {key: torch.tensor([], dtype=self.gram_dtype) for key in self.gram_modules}
         self.linear_probe_epochs = linear_probe_epochs
         self.classifier = None
+        self.merge_state = None  # running sums of the server merge, filled as client infos arrive
 
     def split_backbone_head(self):
         backbone_params = []
@@ -183,26 +195,23 @@ class RegMean(BaseModel):
                     alpha = self.alpha_regmean[1]
                 else:
                     alpha = self.alpha_regmean[0]
-                self.features[name] = self.features[name].to("cpu")
-                shape = self.features[name].shape[-1]
-                self.features[name] = (
-                    self.features[name] * alpha
-                    + (1 - alpha) * torch.eye(shape, dtype=self.gram_dtype) * self.features[name]
-                )
+                self.features[name] = regularize_gram_(self.features[name].to("cpu"), alpha)
                 hooks[name].remove()
 
     def hook_handler(self, name):
         def hook_forward(module, inputs, _):
             x = inputs[0].detach().to(self.gram_dtype)
-            if len(x.shape) == 3:
-                x = x.view(-1, x.size(-1))
-            tmp = torch.zeros(x.size(-1), x.size(-1), device=self.device, dtype=self.gram_dtype)
-            torch.matmul(x.T, x, out=tmp)
-            self.features[name] = self.features[name].to(self.device)
-            if len(self.features[name]) == 0:
-                self.features[name] = tmp
+            x = x.reshape(-1, x.size(-1))
+            gram = self.features[name]
+            if gram.numel() == 0:
+                gram = torch.zeros(x.size(-1), x.size(-1), device=x.device, dtype=self.gram_acc_dtype)
+            elif gram.device != x.device:
+                gram = gram.to(x.device)
+            if gram.dtype == x.dtype:
+                gram.addmm_(x.T, x)
             else:
-                self.features[name] += tmp
+                gram.add_(x.T @ x)
+            self.features[name] = gram
 
         return hook_forward
 
@@ -211,10 +220,15 @@ class RegMean(BaseModel):
         if client_info is None:
             client_info = {}
         client_info["state_dict"] = deepcopy(self.network.state_dict())
-        client_info["grams"] = deepcopy(self.features)
+        client_info["grams"] = self.ship_grams(self.features)
         client_info["num_train_samples"] = len(dataloader.dataset.data)
         return client_info
 
+    def ship_grams(self, grams: dict) -> dict:
+        if self.gram_pack:
+            return {name: pack_gram(gram, self.gram_comm_dtype) for name, gram in grams.items()}
+        return {name: gram.clone() for name, gram in grams.items()}
+
     def to(self, device="cpu"):
         self.network.to(device)
         for name in self.gram_modules:
@@ -224,37 +238,54 @@ class RegMean(BaseModel):
     def get_server_info(self):
         return {"state_dict": deepcopy(self.network.state_dict())}
 
-    def end_round_server(self, client_info: List[dict]):
+    def accumulate_regmean(self, state_dict: dict, grams: dict, num_train_samples: int, keys: List[str] = None):
+        # adds W_k G_k and G_k for the regmean layers, and the weighted W_k for the other layers, to the running sums
+        dtype = torch.float64 if self.reg_dtype_64 else self.gram_dtype
+        if self.merge_state is None:
+            self.merge_state = {"weights_grams": {}, "grams": {}, "others": {}, "norm": 0}
+        state = self.merge_state
         if self.avg_type == "weighted":
-            total_samples = sum([client["num_train_samples"] for client in client_info])
-            norm_weights = [client["num_train_samples"] / total_samples for client in client_info]
+            weight = num_train_samples
         else:
-            weights = [1 if client["num_train_samples"] > 0 else 0 for client in client_info]
-            norm_weights = [w / sum(weights) for w in weights]
-        dtype = torch.float64 if self.reg_dtype_64 else self.gram_dtype
-        # regmean solution
-        keys = list(self.network.state_dict().keys())
-        sd = self.network.state_dict()
-        for key in keys:
-            if (
-                "weight" in key and self.middle_names.get(key) is not None
-            ):  # it means that we apply regmean to this layer
-                name = self.middle_names[key]
-                sd[key] = (
-                    torch.stack(
-                        [
-                            client["state_dict"][key].to(dtype) @ client["grams"][name].to(dtype)
-                            for client in client_info
-                        ]
-                    ).sum(0)
-                    @ torch.pinverse(torch.stack([client["grams"][name].to(dtype) for client in client_info]).sum(0))
-                ).to(torch.float32)
+            weight = 1 if num_train_samples > 0 else 0
+        for key in state_dict.keys() if keys is None else keys:
+            value = state_dict[key].detach()
+            if "weight" in key and self.middle_names.get(key) is not None:
+                gram = unpack_gram(grams[self.middle_names[key]], dtype).to(value.device)
+                weights_gram = value.to(dtype) @ gram
+                if key in state["grams"]:
+                    state["weights_grams"][key] += weights_gram
+                    state["grams"][key] += gram
+                else:
+                    state["weights_grams"][key] = weights_gram
+                    state["grams"][key] = gram.clone()
+            elif key in state["others"]:
+                state["others"][key] += value * weight
             else:
-                sd[key] = torch.stack(
-                    [client["state_dict"][key] * norm_weight for client, norm_weight in zip(client_info, norm_weights)]
-                ).sum(
-                    0
-                )  # fedavg for the other layers
+                state["others"][key] = value * weight
+        state["norm"] += weight
+
+    def solve_regmean(self) -> dict:
+        state = self.merge_state
+        systems = {key: (weights_gram, state["grams"][key]) for key, weights_gram in state["weights_grams"].items()}
+        merged = {key: weight.to(torch.float32) for key, weight in solve_gram_systems(systems).items()}
+        for key, value in state["others"].items():
+            merged[key] = value / state["norm"]  # fedavg for the other layers
+        self.merge_state = None
+        return merged
+
+    def receive_client_info(self, client_info: dict) -> dict:
+        # the client payload is folded into the running sums and dropped, so the server memory does not grow with
+        # the number of clients
+        self.accumulate_regmean(client_info["state_dict"], client_info["grams"], client_info["num_train_samples"])
+        return {"num_train_samples": client_info["num_train_samples"]}
+
+    def end_round_server(self, client_info: List[dict]):
+        for client in client_info:
+            if "state_dict" in client:  # not streamed through receive_client_info
+                self.accumulate_regmean(client["state_dict"], client["grams"], client["num_train_samples"])
+        sd = self.network.state_dict()
+        sd.update(self.solve_regmean())
         self.network.load_state_dict(sd)
 
     def end_task_client(self, dataloader: DataLoader = None, server_info: dict = None):
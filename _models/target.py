@@ -58,6 +58,12 @@ train_transform = transforms.Compose([
     transforms.ToTensor(),
     transforms.Normalize(**dict(data_normalize)),
 ])
+# same augmentation as train_transform, applied on the device to batches of synthetic images
+syn_transform = augmentation.AugmentationSequential(
+    augmentation.RandomResizedCrop(size=(224, 224), resample="bicubic"),
+    augmentation.RandomHorizontalFlip(),
+    augmentation.Normalize(mean=data_normalize["mean"], std=data_normalize["std"]),
+)
     
 #else:
 #    synthesis_batch_size = 16
@@ -113,57 +119,6 @@ class Normalizer(object):
 normalizer = Normalizer(**dict(data_normalize))
 
 
-def _collect_all_images(nums, root, postfix=['png', 'jpg', 'jpeg', 'JPEG']):
-    images = []
-    if isinstance( postfix, str):
-        postfix = [ postfix ]
-    for dirpath, dirnames, files in os.walk(root):
-        for pos in postfix:
-            if nums != None:
-                files.sort()
-                # random.shuffle(files)
-                files = files[:nums]
-                # files = files[20*256:20*256+nums]       # discard the ealry-stage data
-                # files = files[-nums:]  # 40*256 
-            for f in files:
-                if f.endswith(pos):
-                    images.append( os.path.join( dirpath, f ) )
-    return images
-
-
-class DataIter(object):
-    def __init__(self, dataloader):
-        self.dataloader = dataloader
-        self._iter = iter(self.dataloader)
-    
-    def next(self):
-        try:
-            data = next( self._iter )
-        except StopIteration:
-            self._iter = iter(self.dataloader)
-            data = next( self._iter )
-        return data
-
-
-class UnlabeledImageDataset(torch.utils.data.Dataset):
-    def __init__(self, root, transform=None, nums=None):
-        self.root = os.path.abspath(root)
-        self.images = _collect_all_images(nums, self.root) #[ os.path.join(self.root, f) for f in os.listdir( root ) ]
-        self.transform = transform
-
-    def __getitem__(self, idx):
-        img = Image.open( self.images[idx] )
-        if self.transform:
-            img = self.transform(img)
-        return img
-
-    def __len__(self):
-        return len(self.images)
-
-    def __repr__(self):
-        return 'Unlabeled data:\n\troot: %s\n\tdata mount: %d\n\ttransforms: %s'%(self.root, len(self), self.transform)
-
-
 def pack_images(images, col=None, channel_last=False, padding=1):
     # N, C, H, W
     if isinstance(images, (list, tuple) ):
@@ -274,18 +229,57 @@ class DeepInversionHook():
         self.hook.remove()
 
 
-class ImagePool(object):
-    def __init__(self, root):
-        self.root = os.path.abspath(root)
-        os.makedirs(self.root, exist_ok=True)
-        self._idx = 0
+class SyntheticPool(object):
+    """Synthetic images stored as uint8 tensors, in memory or appended to a file read back as a memory map
+    when `path` is given. Batches are sampled directly from the pool and augmented on the device."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.shape = None
+        self._len = 0
+        self._chunks = []
+        self._images = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            open(path, "wb").close()
+
+    def __len__(self):
+        return self._len
 
     def add(self, imgs, targets=None):
-        save_image_batch(imgs, os.path.join( self.root, "%d.png"%(self._idx) ), pack=False)
-        self._idx+=1
+        imgs = (imgs.detach().clamp(0, 1) * 255).to(torch.uint8).cpu()
+        self.shape = tuple(imgs.shape[1:])
+        if self.path is None:
+            self._chunks.append(imgs)
+        else:
+            with open(self.path, "ab") as f:
+                f.write(imgs.contiguous().numpy().tobytes())
+        self._len += imgs.shape[0]
+        self._images = None
+
+    def images(self, nums=None):
+        if self._images is None:
+            if self.path is None:
+                self._images = torch.cat(self._chunks)
+                self._chunks = [self._images]
+            else:
+                self._images = torch.from_numpy(np.memmap(self.path, dtype=np.uint8, mode="c", shape=(self._len, *self.shape)))
+        return self._images if nums is None else self._images[:nums]
 
-    def get_dataset(self, nums=None, transform=None, labeled=True):
-        return UnlabeledImageDataset(self.root, transform=transform, nums=nums)
+    @staticmethod
+    def decode(images, device):
+        return syn_transform(images.to(device, non_blocking=True).float().div_(255))
+
+    def sample(self, batch_size, device, nums=None):
+        images = self.images(nums)
+        return self.decode(images[torch.randperm(len(images))[:batch_size]], device)
+
+    def batches(self, batch_size, device, nums=None):
+        # endless shuffled batches, reshuffled at every pass over the pool
+        while True:
+            images = self.images(nums)
+            for indexes in torch.randperm(len(images)).split(batch_size):
+                yield self.decode(images[indexes], device)
 
 
 class Generator(nn.Module):
@@ -349,14 +343,13 @@ class GlobalSynthesizer(ABC):
                     init_dataset=None, iterations=100, lr_g=0.1,
                     synthesis_batch_size=128, sample_batch_size=128, 
                     adv=0.0, bn=1, oh=1,
-                    save_dir='run/fast', transform=None, autocast=None, use_fp16=False,
+                    data_pool=None, transform=None, autocast=None, use_fp16=False,
                     normalizer=None, distributed=False, lr_z = 0.01,
                     warmup=10, reset_l0=0, reset_bn=0, bn_mmt=0,
                     is_maml=1, fabric = None):#, args=None):
         super(GlobalSynthesizer, self).__init__()
         self.teacher = teacher
         self.student = student
-        self.save_dir = save_dir
         self.img_size = img_size 
         self.iterations = iterations
         self.lr_g = lr_g
@@ -373,7 +366,7 @@ class GlobalSynthesizer(ABC):
         self.sample_batch_size = sample_batch_size
         self.normalizer = normalizer
 
-        self.data_pool = ImagePool(root=self.save_dir)
+        self.data_pool = SyntheticPool() if data_pool is None else data_pool
         self.transform = transform
         self.generator = generator.cuda().train()
         self.ep = 0
@@ -581,6 +574,7 @@ class Target(FedAvg):
         nums: int = 8000,
         kd_alpha: float = 25,
         save_dir: str = "synthetic_data",
+        syn_mmap: str_to_bool = False,
     ) -> None:
         super().__init__(
             fabric,
@@ -594,7 +588,8 @@ class Target(FedAvg):
         self.tasks = tasks
         self.batch_size = batch_size
         self.save_dir = save_dir
-        if os.path.exists(self.save_dir):
+        self.syn_mmap = syn_mmap  # synthetic images in memory-mapped files under save_dir instead of RAM
+        if self.syn_mmap and os.path.exists(self.save_dir):
             shutil.rmtree(self.save_dir)
         self.dataset = dataset
         if "cifar" in dataset:
@@ -611,7 +606,7 @@ class Target(FedAvg):
             self.dataset_size = 8000
         self.nums = nums
         self.total_classes = []
-        self.syn_data_loader = None
+        self.syn_pool = None  # synthetic images of the previous task
         self.old_network = None
         self.kd_alpha = kd_alpha
 
@@ -621,8 +616,8 @@ class Target(FedAvg):
             inputs = self.augment(inputs)
             outputs = self.network(inputs)[:, self.cur_offset : self.cur_offset + self.cpt]
             loss = self.loss(outputs, labels - self.cur_offset)
-            if self.syn_data_loader is not None:
-                syn_inputs = next(iter(self.syn_data_loader)).cuda()
+            if self.syn_pool is not None:
+                syn_inputs = self.syn_pool.sample(16, self.device, nums=self.nums)
                 syn_outputs = self.network(syn_inputs)[:, : self.cur_offset]
                 with torch.no_grad():
                     syn_old_outputs = self.old_network(syn_inputs)[:, : self.cur_offset]
@@ -647,6 +642,7 @@ class Target(FedAvg):
         server_info = super().get_server_info()
         if self.cur_task > 0:
             server_info["old_network"] = deepcopy(self.old_network)
+            server_info["syn_pool"] = self.syn_pool
         return server_info
 
     def begin_round_client(self, dataloader: DataLoader, server_info: dict):
@@ -658,12 +654,11 @@ class Target(FedAvg):
         optimizer = self.optimizer_class(params, lr=self.lr, weight_decay=self.wd)
         self.optimizer = self.fabric.setup_optimizers(optimizer)
         if self.cur_task > 0:
-            self.syn_data_loader = self.fabric.setup_dataloaders(self.get_syn_data_loader())
-            self.it = DataIter(self.syn_data_loader)
+            self.syn_pool = server_info["syn_pool"]
             self.old_network = self.old_network.to(self.device)
 
     def end_round_client(self, dataloader: DataLoader):
-        self.syn_data_loader = None
+        self.syn_pool = None
         self.optimizer.zero_grad()
         self.optimizer = None
         if self.old_network is not None:
@@ -671,13 +666,12 @@ class Target(FedAvg):
         self.network = self.network.to("cpu")
 
 
-    def kd_train(self, student, teacher, criterion, optimizer):
+    def kd_train(self, student, teacher, criterion, optimizer, data_pool):
         student.train()
         teacher.eval()
-        loader = self.get_all_syn_data() 
-        data_iter = DataIter(loader)
+        data_iter = data_pool.batches(sample_batch_size, self.device, nums=self.nums)
         for i in range(kd_steps):
-            images = data_iter.next().cuda()  
+            images = next(data_iter)
             with torch.no_grad():
                 t_out = teacher(images)#["logits"]
             s_out = student(images.detach())#["logits"]
@@ -702,13 +696,11 @@ class Target(FedAvg):
         generator = Generator(nz=nz, ngf=64, img_size=img_size, nc=3).cuda()
         student = deepcopy(self.network)
         student.apply(weight_init)
-        tmp_dir = os.path.join(self.save_dir, "task_{}".format(self.cur_task))
-        if not os.path.exists(tmp_dir):
-            os.makedirs(tmp_dir) 
+        data_pool = SyntheticPool(os.path.join(self.save_dir, "task_{}.bin".format(self.cur_task)) if self.syn_mmap else None)
         latest_class = self.total_classes[-1]
         synthesizer = GlobalSynthesizer(deepcopy(self.network), student, generator,
                     nz=nz, num_classes=latest_class, img_size=img_shape, init_dataset=None,
-                    save_dir=tmp_dir,
+                    data_pool=data_pool,
                     transform=train_transform, normalizer=normalizer,
                     synthesis_batch_size=synthesis_batch_size, sample_batch_size=sample_batch_size,
                     iterations=g_steps, warmup=warmup, lr_g=lr_g, lr_z=lr_z,
@@ -724,7 +716,7 @@ class Target(FedAvg):
         for it in tqdm(range(syn_round), desc="Data Generation"):
             synthesizer.synthesize() # generate synthetic data
             if it >= warmup:
-                loss = self.kd_train(student, self.network, criterion, optimizer) # kd_steps
+                loss = self.kd_train(student, self.network, criterion, optimizer, data_pool) # kd_steps
                 #test_acc = self._compute_accuracy(student, self.test_loader)
                 #print("Task {}, Data Generation, Epoch {}/{} =>  Student test_acc: {:.2f}".format(
                 #    self.cur_task, it + 1, syn_round, test_acc,))
@@ -735,35 +727,9 @@ class Target(FedAvg):
 
 
         print("For task {}, data generation completed! ".format(self.cur_task))  
+        self.syn_pool = data_pool
 
             
-    def get_syn_data_loader(self):
-        #if self.args["dataset"] =="cifar100":
-        #    dataset_size = 50000
-        #elif self.args["dataset"] == "tiny_imagenet":
-        #    dataset_size = 100000
-        #elif self.args["dataset"] == "imagenet100":
-        #    dataset_size = 130000
-        dataset_size = self.dataset_size
-        iters = math.ceil(dataset_size / (self.num_clients*self.tasks*self.batch_size))
-        syn_bs = 16 #int(self.nums/iters)
-        data_dir = os.path.join(self.save_dir, "task_{}".format(self.cur_task-1))
-        print("iters{}, syn_bs:{}, data_dir: {}".format(iters, syn_bs, data_dir))
-
-        syn_dataset = UnlabeledImageDataset(data_dir, transform=train_transform, nums=self.nums)
-        syn_data_loader = torch.utils.data.DataLoader(
-            syn_dataset, batch_size=syn_bs, shuffle=True,
-            num_workers=0)
-        return syn_data_loader
-
-    def get_all_syn_data(self):
-        data_dir = os.path.join(self.save_dir, "task_{}".format(self.cur_task))
-        syn_dataset = UnlabeledImageDataset(data_dir, transform=train_transform, nums=self.nums)
-        loader = torch.utils.data.DataLoader(
-            syn_dataset, batch_size=sample_batch_size, shuffle=True,
-            num_workers=0, pin_memory=True, sampler=None)
-        return loader
-
     def end_round_server(self, client_info: List[dict]) -> None:
         super().end_round_server(client_info)
 
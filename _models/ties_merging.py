@@ -8,7 +8,6 @@ from _models._utils import BaseModel
 from utils.tools import str_to_bool
 from _networks.vit_prompt_hgp import VitHGP
 from _networks.vit import VisionTransformer
-import numpy as np
 
 
 @register_model("ties_merging")
@@ -25,6 +24,8 @@ class TiesMerging(BaseModel):
         avg_type: str = "weighted",
         linear_probe: str_to_bool = False,
         slca: str_to_bool = False,
+        ties_trim: float = 0.7,
+        ties_scale: float = 0.4,
     ) -> None:
         self.slca = slca
         self.lr = lr
@@ -55,6 +56,9 @@ class TiesMerging(BaseModel):
         self.avg_type = avg_type
         self.do_linear_probe = linear_probe
         self.done_linear_probe = False
+        self.ties_trim = ties_trim  # fraction of each client delta (smallest magnitudes) set to zero
+        self.ties_scale = ties_scale
+        self.ties_state = None  # running sums of the merge, filled as client infos arrive
 
     def observe(self, inputs: torch.Tensor, labels: torch.Tensor, update: bool = True) -> float:
         aug_inputs = self.augment(inputs)
@@ -87,34 +91,54 @@ class TiesMerging(BaseModel):
                 self.fabric.backward(loss)
                 self.optimizer.step()
 
-    def end_round_server(self, client_info: List[dict]):
-        with torch.no_grad():
-            cur_params = self.network.get_params()
-            for client in client_info:
-                client["params"] -= cur_params.to(client["params"].device)
+    def trim(self, delta: torch.Tensor) -> torch.Tensor:
+        # zeroes the entries below the ties_trim quantile of the magnitudes (as np.quantile, linear interpolation)
+        magnitude = delta.abs()
+        position = self.ties_trim * (magnitude.numel() - 1)
+        threshold = torch.kthvalue(magnitude.float(), int(position) + 1).values
+        if position > int(position):
+            drop = magnitude <= threshold
+        else:
+            drop = magnitude < threshold
+        return delta.masked_fill_(drop, 0)
 
-            for client in client_info:
-                quantile = np.quantile(client["params"].abs().detach().cpu(), 0.7)
-                client["params"][client["params"].abs() < quantile] = 0
-            
-            weights_sum = 0
-            for client in client_info:
-                weights_sum += client["params"]
-            positive = weights_sum > 0
-            negative = weights_sum < 0
+    def accumulate_ties(self, params: torch.Tensor):
+        # sign election and disjoint mean only need the positive and negative sums and counts of the trimmed deltas
+        with torch.no_grad():
+            if self.ties_state is None:
+                base = self.network.get_params().detach()
+                self.ties_state = {
+                    "base": base,
+                    "positive_sum": torch.zeros_like(base),
+                    "negative_sum": torch.zeros_like(base),
+                    "positive_count": torch.zeros_like(base, dtype=torch.int32),
+                    "negative_count": torch.zeros_like(base, dtype=torch.int32),
+                }
+            state = self.ties_state
+            delta = self.trim(params.detach().to(state["base"].device) - state["base"])
+            state["positive_sum"] += delta.clamp(min=0)
+            state["negative_sum"] += delta.clamp(max=0)
+            state["positive_count"] += delta > 0
+            state["negative_count"] += delta < 0
+
+    def receive_client_info(self, client_info: dict) -> dict:
+        self.accumulate_ties(client_info["params"])
+        return {"num_train_samples": client_info["num_train_samples"]}
 
-            final_vector = 0
-            sum_elements = 0
+    def end_round_server(self, client_info: List[dict]):
+        with torch.no_grad():
             for client in client_info:
-                positive_times_params = client["params"].clamp(min=0) * positive.int()
-                final_vector += positive_times_params
-                negative_times_params = client["params"].clamp(max=0) * negative.int()
-                final_vector += negative_times_params
-
-                sum_elements += (positive_times_params > 0).int() + (negative_times_params < 0).int()
-            final_vector[sum_elements > 0] /= sum_elements[sum_elements > 0]
-
-            self.network.set_params(cur_params + 0.4 * final_vector.to(cur_params.device))
+                if "params" in client:  # not streamed through receive_client_info
+                    self.accumulate_ties(client["params"])
+            state = self.ties_state
+            self.ties_state = None
+            elected = state["positive_sum"] + state["negative_sum"]
+            final_vector = torch.where(
+                elected > 0,
+                state["positive_sum"] / state["positive_count"].clamp(min=1),
+                torch.where(elected < 0, state["negative_sum"] / state["negative_count"].clamp(min=1), 0.0),
+            )
+            self.network.set_params(state["base"] + self.ties_scale * final_vector)
 
     def begin_round_client(self, dataloader: DataLoader, server_info: dict):
         self.network.set_params(server_info["params"])
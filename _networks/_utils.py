@@ -1,5 +1,10 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from typing import Callable
+
+# F.scaled_dot_product_attention takes the `scale` keyword from torch 2.1, the explicit attention is used before
+SDPA_WITH_SCALE = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2]) >= (2, 1)
 
 
 class BaseNetwork(nn.Module):
@@ -31,4 +36,60 @@ class BaseNetwork(nn.Module):
             cand_grads = new_grads[progress: progress +
                                    torch.tensor(pp.size()).prod()].view(pp.size())
             progress += torch.tensor(pp.size()).prod()
-            pp.grad = cand_grads
\ No newline at end of file
+            pp.grad = cand_grads
+
+
+class FrozenQuantizer:
+    """Keeps an int8 dynamic-quantized copy of a module, used for the no-grad forwards on CPU.
+
+    Only the Linear layers that are frozen when the copy is built get quantized; every other parameter
+    and buffer of the copy is tied to the original module before each use, so prompts, heads and
+    adapters stay current. The first batch is run through both copies and quantization is dropped if
+    the features drift from fp32 (cosine similarity below `min_similarity`).
+    """
+
+    def __init__(self, enabled: bool = False, min_similarity: float = 0.99) -> None:
+        self.enabled = enabled
+        self.min_similarity = min_similarity
+        self.quantized = None
+
+    def __getstate__(self):
+        # the copy is rebuilt lazily, deepcopies and checkpoints do not carry it
+        return {**self.__dict__, "quantized": None}
+
+    def quantize(self, module: nn.Module) -> nn.Module:
+        frozen = {
+            name: torch.ao.quantization.default_dynamic_qconfig
+            for name, m in module.named_modules()
+            if type(m) == nn.Linear and not any(p.requires_grad for p in m.parameters())
+        }
+        return torch.ao.quantization.quantize_dynamic(module, frozen, dtype=torch.qint8, inplace=False)
+
+    def tie(self, module: nn.Module) -> nn.Module:
+        quantized_modules = dict(self.quantized.named_modules())
+        for prefix, m in module.named_modules():
+            target = quantized_modules.get(prefix)
+            if type(target) == type(m):  # quantized Linears are the only modules whose type changed
+                target._parameters.update(m._parameters)
+                target._buffers.update(m._buffers)
+        return self.quantized.train(module.training)
+
+    def get(self, module: nn.Module, inputs: torch.Tensor, forward: Callable = None) -> nn.Module:
+        """Returns the module to run on `inputs`: the quantized copy when it applies, `module` otherwise.
+
+        `forward(module, inputs)` computes the features compared in the accuracy check (defaults to calling the module).
+        """
+        if not self.enabled or torch.is_grad_enabled() or inputs.device.type != "cpu":
+            return module
+        if self.quantized is None:
+            forward = forward if forward is not None else lambda m, x: m(x)
+            self.quantized = self.quantize(module)
+            reference = forward(module, inputs)
+            features = forward(self.tie(module), inputs)
+            similarity = F.cosine_similarity(features.flatten(1).float(), reference.flatten(1).float()).min().item()
+            if similarity < self.min_similarity:
+                print(f"int8 backbone disabled: cosine similarity to fp32 {similarity:.4f} < {self.min_similarity}")
+                self.enabled = False
+                self.quantized = None
+                return module
+        return self.tie(module)
@@ -1,7 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from _networks._utils import BaseNetwork
+from _networks._utils import BaseNetwork, FrozenQuantizer, SDPA_WITH_SCALE
 from .vit import VisionTransformer
 import copy
 import timm
@@ -36,6 +37,8 @@ class Mlp(nn.Module):
 
 
 class Attention(nn.Module):
+    fused_attn = SDPA_WITH_SCALE  # the explicit path is still taken when register_hook is set
+
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.0, proj_drop=0.0):
         super().__init__()
         self.num_heads = num_heads
@@ -73,15 +76,22 @@ class Attention(nn.Module):
             k = torch.cat((pk, k), dim=2)
             v = torch.cat((pv, v), dim=2)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused_attn and not register_hook:
+            x = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+
+            if register_hook:
+                self.save_attention_map(attn)
+                attn.register_hook(self.save_attn_gradients)
 
-        if register_hook:
-            self.save_attention_map(attn)
-            attn.register_hook(self.save_attn_gradients)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -454,7 +464,7 @@ def tensor_prompt(a, b, c=None, ortho=False):
 
 @register_network("vit_prompt_coda")
 class ViTZoo(BaseNetwork):
-    def __init__(self, model_name:str = "vit_base_patch16_224.augreg_in21k", pretrained:str_to_bool = True, num_tasks: int = 10, num_classes: int = 100, pool_size: int = 100, prompt_length: int = 8):
+    def __init__(self, model_name:str = "vit_base_patch16_224.augreg_in21k", pretrained:str_to_bool = True, num_tasks: int = 10, num_classes: int = 100, pool_size: int = 100, prompt_length: int = 8, quantize_frozen: str_to_bool = False):
         super(ViTZoo, self).__init__()
         prompt_param = [num_tasks, [pool_size, prompt_length, 0]]
         self.prompt_param = prompt_param
@@ -476,15 +486,17 @@ class ViTZoo(BaseNetwork):
 
         # feature encoder changes if transformer vs resnet
         self.feat = zoo_model
+        self.quantizer = FrozenQuantizer(quantize_frozen)
 
     # pen: get penultimate features
     def forward(self, x, pen=False, train=False):
 
         if self.prompt is not None:
             with torch.no_grad():
-                q, _ = self.feat(x)
+                q, _ = self.quantizer.get(self.feat, x, lambda feat, x: feat(x)[0][:, 0, :])(x)
                 q = q[:, 0, :]
-            out, prompt_loss = self.feat(x, prompt=self.prompt, q=q, train=train, task_id=self.task_id)
+            feat = self.quantizer.get(self.feat, x)
+            out, prompt_loss = feat(x, prompt=self.prompt, q=q, train=train, task_id=self.task_id)
             out = out[:, 0, :]
         else:
             out, _ = self.feat(x)
@@ -9,7 +9,7 @@ import torch.utils.checkpoint
 from timm.models import named_apply
 from timm.layers import trunc_normal_, lecun_normal_, PatchEmbed, Mlp as TimmMlp, DropPath
 from _networks import register_network
-from _networks._utils import BaseNetwork
+from _networks._utils import BaseNetwork, FrozenQuantizer, SDPA_WITH_SCALE
 
 from timm.models._builder import build_model_with_cfg
 from functools import partial
@@ -124,8 +124,10 @@ class Attention(nn.Module):
 
         # NOTE: flash attention is less debuggable than the original. Use the commented code below if in trouble.
         # check torch version
-        if torch.__version__ >= '2.1.0':
-            x = F.scaled_dot_product_attention(q, k, v, scale=self.scale, dropout_p=self.attn_drop.p)
+        if SDPA_WITH_SCALE:
+            x = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
         else:
             print("Torch verison < 2.1.0 detected. Using the original attention code.")
             attn = (q @ k.transpose(-2, -1)) * self.scale
@@ -197,6 +199,8 @@ class Block(nn.Module):
 #attention.py
 
 class PreT_Attention(nn.Module):
+    fused_attn = SDPA_WITH_SCALE  # set to False to fall back to the explicit attention matrix
+
     def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.):
         super().__init__()
         assert dim % num_heads == 0, 'dim should be divisible by num_heads'
@@ -228,11 +232,17 @@ class PreT_Attention(nn.Module):
             k = torch.cat([key_prefix, k], dim=2)
             v = torch.cat([value_prefix, v], dim=2)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused_attn:
+            x = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -942,7 +952,8 @@ class VitDual(BaseNetwork):
                  num_tasks: int = 10, 
                  num_classes: int = 100, 
                  pool_size: int = 100, 
-                 prompt_length: int = 20):
+                 prompt_length: int = 20,
+                 quantize_frozen: str_to_bool = False):
         super().__init__()
         self.n_classes = num_classes
         drop = 0.0
@@ -955,6 +966,8 @@ class VitDual(BaseNetwork):
             drop_path_rate=drop_path,
         )
         self.original_model.eval()
+        self.query_quantizer = FrozenQuantizer(quantize_frozen)
+        self.quantizer = FrozenQuantizer(quantize_frozen)
         top_k = 1
         length = prompt_length
         prompt_pool = True
@@ -1019,12 +1032,16 @@ class VitDual(BaseNetwork):
 
         with torch.no_grad():
             if self.original_model is not None:
-                original_model_output = self.original_model(x)
+                original_model = self.query_quantizer.get(self.original_model, x, lambda m, x: m(x)['pre_logits'])
+                original_model_output = original_model(x)
                 cls_features = original_model_output['pre_logits']
             else:
                 cls_features = None
 
-        outputs = self.model(x, task_id=task_id, cls_features=cls_features, train=train)
+        model = self.quantizer.get(
+            self.model, x, lambda m, x: m(x, task_id=task_id, cls_features=cls_features, train=train)['pre_logits']
+        )
+        outputs = model(x, task_id=task_id, cls_features=cls_features, train=train)
 
         if return_outputs:
             return outputs
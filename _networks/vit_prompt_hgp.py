@@ -1,10 +1,11 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from .vit import VisionTransformer
 import copy
 import timm
 from _networks import register_network
-from _networks._utils import BaseNetwork
+from _networks._utils import BaseNetwork, SDPA_WITH_SCALE
 import timm.models.vision_transformer as timm_vit
 from functools import partial
 from timm.models.vision_transformer import PatchEmbed
@@ -208,6 +209,8 @@ class Mlp(nn.Module):
 
 
 class Attention(nn.Module):
+    fused_attn = SDPA_WITH_SCALE  # the explicit path is still taken when register_hook is set
+
     def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.0, proj_drop=0.0):
         super().__init__()
         self.num_heads = num_heads
@@ -245,15 +248,22 @@ class Attention(nn.Module):
             k = torch.cat((pk, k), dim=2)
             v = torch.cat((pv, v), dim=2)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused_attn and not register_hook:
+            x = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+
+            if register_hook:
+                self.save_attention_map(attn)
+                attn.register_hook(self.save_attn_gradients)
 
-        if register_hook:
-            self.save_attention_map(attn)
-            attn.register_hook(self.save_attn_gradients)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
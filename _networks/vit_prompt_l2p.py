@@ -1,8 +1,9 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import timm
 from _networks import register_network
-from _networks._utils import BaseNetwork
+from _networks._utils import BaseNetwork, FrozenQuantizer, SDPA_WITH_SCALE
 import torchvision.transforms as transforms
 from utils.tools import str_to_bool
 from timm.models.layers import PatchEmbed, Mlp, DropPath, trunc_normal_, lecun_normal_
@@ -158,6 +159,8 @@ class Prompt(nn.Module):
 
 
 class Attention(nn.Module):
+    fused_attn = SDPA_WITH_SCALE  # set to False to fall back to the explicit attention matrix
+
     def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0.0, proj_drop=0.0):
         super().__init__()
         assert dim % num_heads == 0, "dim should be divisible by num_heads"
@@ -175,11 +178,17 @@ class Attention(nn.Module):
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv.unbind(0)  # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.fused_attn:
+            x = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -578,6 +587,7 @@ class VitL2P(BaseNetwork):
         prompt_pool: str_to_bool = True,
         pool_size: int = 10,
         num_tasks: int = 10,
+        quantize_frozen: str_to_bool = False,
     ):
         super().__init__()
         vit_model = VisionTransformer(
@@ -603,13 +613,15 @@ class VitL2P(BaseNetwork):
         # prompt_param = [n_prompts, prompt_length]
         # self.prompt = Prompt()
         self.feat = vit_model
+        self.quantizer = FrozenQuantizer(quantize_frozen)
 
     def forward(self, x, return_outputs=True):
         with torch.no_grad():
-            cls_features = self.feat.forward_features(x, use_prompt=False)
+            feat = self.quantizer.get(self.feat, x, lambda feat, x: feat.forward_features(x, use_prompt=False)["x"][:, 0, :])
+            cls_features = feat.forward_features(x, use_prompt=False)
             cls_features = cls_features["x"][:, 0, :]
 
-        res = self.feat.forward_features(x, task_id=-1, cls_features=cls_features, train=self.training, use_prompt=True)
+        res = self.quantizer.get(self.feat, x).forward_features(x, task_id=-1, cls_features=cls_features, train=self.training, use_prompt=True)
         x = res["x"]
         x = x[:, 0 : self.feat.total_prompt_len + 1]
         pre_logits = x.mean(dim=1)
@@ -7,7 +7,8 @@ from torch import nn
 import torch.nn.functional as F
 #from backbone import MammothBackbone
 from _networks import register_network
-from _networks._utils import BaseNetwork
+from _networks._utils import BaseNetwork, FrozenQuantizer, SDPA_WITH_SCALE
+from utils.tools import str_to_bool
 #from backbone.vit import vit_base_patch16_224_prompt_prototype
 
 
@@ -103,6 +104,8 @@ class Adapter(nn.Module):
 
 
 class Attention(nn.Module):
+    fused_attn = SDPA_WITH_SCALE  # set to False to fall back to the explicit attention matrix
+
     def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.,):
         super().__init__()
         self.num_heads = num_heads
@@ -124,6 +127,16 @@ class Attention(nn.Module):
     def forward(self, x):
         B, N, C = x.shape
 
+        if self.fused_attn:
+            q = self.q_proj(x).view(B, N, self.num_heads, self.head_dim).transpose(1, 2)
+            k = self.k_proj(x).view(B, N, self.num_heads, self.head_dim).transpose(1, 2)
+            v = self.v_proj(x).view(B, N, self.num_heads, self.head_dim).transpose(1, 2)
+            attn_output = F.scaled_dot_product_attention(
+                q, k, v, scale=self.scale, dropout_p=self.attn_drop.p if self.training else 0.0
+            )
+            x = self.proj(attn_output.transpose(1, 2).reshape(B, N, C))
+            return self.proj_drop(x)
+
         q = self.q_proj(x)
         k = self._shape(self.k_proj(x), -1, B).view(B * self.num_heads, -1, self.head_dim)
         v = self._shape(self.v_proj(x), -1, B).view(B * self.num_heads, -1, self.head_dim)
@@ -460,14 +473,82 @@ from tqdm import tqdm
 import sys
 
 
+class RidgeRegression:
+    """Closed-form ridge regression W = (G + ridge * I)^-1 Q on the statistics G = H^T H and Q = H^T Y.
+
+    H are the features, or their random projection relu(X @ W_rand) when W_rand is given, computed chunk_size
+    samples at a time, so that the (samples x M) projected features are never stored. G and Q are accumulated
+    incrementally and can be merged across clients and tasks. The ridge parameter is selected with one
+    eigendecomposition, every candidate only rescales the eigenvalues.
+    """
+
+    def __init__(self, W_rand: torch.Tensor = None, chunk_size: int = 4096, dtype=torch.float32):
+        self.W_rand = W_rand
+        self.chunk_size = chunk_size
+        self.dtype = dtype
+        self.G = None
+        self.Q = None
+
+    def chunks(self, X: torch.Tensor, Y: torch.Tensor):
+        for start in range(0, X.shape[0], self.chunk_size):
+            H = X[start : start + self.chunk_size].to(self.dtype)
+            if self.W_rand is not None:
+                H = F.relu(H @ self.W_rand.to(H.device, self.dtype))
+            yield H, Y[start : start + self.chunk_size].to(H.device, self.dtype)
+
+    def statistics(self, X: torch.Tensor, Y: torch.Tensor):
+        G, Q = 0, 0
+        for H, Y_chunk in self.chunks(X, Y):
+            G = G + H.T @ H
+            Q = Q + H.T @ Y_chunk
+        return G, Q
+
+    def accumulate(self, X: torch.Tensor, Y: torch.Tensor):
+        G, Q = self.statistics(X, Y)
+        self.merge(G, Q)
+
+    def merge(self, G: torch.Tensor, Q: torch.Tensor):
+        # Q of fewer classes (earlier tasks) is padded with zero columns
+        if self.Q is not None and self.Q.shape[1] != Q.shape[1]:
+            classes = max(self.Q.shape[1], Q.shape[1])
+            self.Q = F.pad(self.Q, (0, classes - self.Q.shape[1]))
+            Q = F.pad(Q, (0, classes - Q.shape[1]))
+        self.G = G if self.G is None else self.G + G
+        self.Q = Q if self.Q is None else self.Q + Q
+
+    def select_ridge(self, X: torch.Tensor, Y: torch.Tensor, ridges=None, fit_fraction: float = 0.8) -> float:
+        # fit on the first fit_fraction of the samples, MSE of every candidate on the rest
+        ridges = 10.0 ** np.arange(-8, 9) if ridges is None else np.asarray(ridges)
+        num_fit = int(X.shape[0] * fit_fraction)
+        G_fit, Q_fit = self.statistics(X[:num_fit], Y[:num_fit])
+        eigvals, eigvecs = torch.linalg.eigh(G_fit)
+        eigvals = eigvals.clamp(min=0)
+        projected_Q = eigvecs.T @ Q_fit
+        scales = 1 / (eigvals.unsqueeze(0) + torch.as_tensor(ridges, dtype=eigvals.dtype, device=eigvals.device).unsqueeze(1))
+        errors = torch.zeros(len(ridges), dtype=torch.float64, device=eigvals.device)
+        for H, Y_chunk in self.chunks(X[num_fit:], Y[num_fit:]):
+            P = H @ eigvecs
+            for i in range(len(ridges)):
+                errors[i] += ((P * scales[i]) @ projected_Q - Y_chunk).pow(2).sum().double()
+        ridge = ridges[int(torch.argmin(errors))]
+        logging.info("Optimal lambda: " + str(ridge))
+        return ridge
+
+    def solve(self, ridge: float) -> torch.Tensor:
+        # returns the classifier weights, (classes x M)
+        eye = torch.eye(self.G.shape[0], dtype=self.G.dtype, device=self.G.device)
+        return torch.linalg.solve(self.G + ridge * eye, self.Q).T  # better nmerical stability than .inv
+
+
 @register_network('vit_ranpac')
 class RanPAC_Model(BaseNetwork):
-    def __init__(self, backbone = None, device = 'cuda'):
+    def __init__(self, backbone = None, device = 'cuda', quantize_frozen: str_to_bool = False):
         super(RanPAC_Model, self).__init__()
         if backbone is None:
             from _networks.vit import VisionTransformer as ViT
             backbone = ViT().model
         self._network = RanPACNet(backbone, device)
+        self.quantizer = FrozenQuantizer(quantize_frozen)
 
     #@property
     #def training(self):
@@ -483,7 +564,8 @@ class RanPAC_Model(BaseNetwork):
         self._network.eval()
     
     def forward(self, x):
-        return self._network(x)
+        x = self.quantizer.get(self._network.convnet, x)(x)
+        return self._network.fc(x)
 
     def replace_fc(self, trainloader):
         self._network = self._network.eval()
@@ -506,7 +588,7 @@ class RanPAC_Model(BaseNetwork):
                 (_, data, label) = batch
                 data = data.to(self._network.device)
                 label = label.to(self._network.device)
-                embedding = self._network.convnet(data)
+                embedding = self.quantizer.get(self._network.convnet, data)(data)
                 Features_f.append(embedding.cpu())
                 label_list.append(label.cpu())
         Features_f = torch.cat(Features_f, dim=0)
@@ -515,14 +597,13 @@ class RanPAC_Model(BaseNetwork):
         Y = target2onehot(label_list, self.total_classnum)
         if self.args['use_RP']:
             # print('Number of pre-trained feature dimensions = ',Features_f.shape[-1])
-            if self.args['M'] > 0:
-                Features_h = torch.nn.functional.relu(Features_f @ self._network.fc.W_rand.cpu())
-            else:
-                Features_h = Features_f
-            self.Q = self.Q + Features_h.T @ Y
-            self.G = self.G + Features_h.T @ Features_h
-            ridge = self.optimise_ridge_parameter(Features_h, Y)
-            Wo = torch.linalg.solve(self.G + ridge * torch.eye(self.G.size(dim=0)), self.Q).T  # better nmerical stability than .inv
+            # G and Q are accumulated over the tasks, the random projection is applied chunk by chunk
+            if getattr(self, "ridge_regression", None) is None:
+                W_rand = self._network.fc.W_rand.cpu() if self.args['M'] > 0 else None
+                self.ridge_regression = RidgeRegression(W_rand)
+            self.ridge_regression.accumulate(Features_f, Y)
+            ridge = self.optimise_ridge_parameter(Features_f, Y)
+            Wo = self.ridge_regression.solve(ridge)
             self._network.fc.weight.data = Wo[0:self._network.fc.weight.shape[0], :].to(self._network.device)
         else:
             for class_index in np.unique(self.train_dataset.labels):
@@ -536,15 +617,5 @@ class RanPAC_Model(BaseNetwork):
                     self._network.fc.weight.data[class_index] = class_prototype  # for cil, only new classes get updated
 
     def optimise_ridge_parameter(self, Features, Y):
-        ridges = 10.0**np.arange(-8, 9)
-        num_val_samples = int(Features.shape[0] * 0.8)
-        losses = []
-        Q_val = Features[0:num_val_samples, :].T @ Y[0:num_val_samples, :]
-        G_val = Features[0:num_val_samples, :].T @ Features[0:num_val_samples, :]
-        for ridge in ridges:
-            Wo = torch.linalg.solve(G_val + ridge * torch.eye(G_val.size(dim=0)), Q_val).T  # better nmerical stability than .inv
-            Y_train_pred = Features[num_val_samples::, :] @ Wo.T
-            losses.append(F.mse_loss(Y_train_pred, Y[num_val_samples::, :]))
-        ridge = ridges[np.argmin(np.array(losses))]
-        logging.info("Optimal lambda: " + str(ridge))
-        return ridge
\ No newline at end of file
+        # Features are the backbone features, projected (if needed) by the ridge regression
+        return self.ridge_regression.select_ridge(Features, Y)
\ No newline at end of file
@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from _models._utils import Buffer, reservoir_indexes
+
+
+def test_reservoir_indexes_fill_then_sample():
+    np.random.seed(0)
+    indexes = reservoir_indexes(7, 10, 6)
+    # the free slots are filled in order, the examples after them replace a random slot or are discarded
+    assert indexes[:3].tolist() == [7, 8, 9]
+    assert ((indexes[3:] >= -1) & (indexes[3:] < 10)).all()
+    assert (reservoir_indexes(0, 10, 10) == np.arange(10)).all()
+
+
+def test_buffer_bookkeeping_across_buffer_size():
+    np.random.seed(0)
+    buffer = Buffer(10)
+    ids = torch.arange(16)
+    for start in range(0, 16, 4):
+        batch = ids[start : start + 4]
+        buffer.add_data(examples=batch.float().view(-1, 1), labels=batch)
+        assert buffer.num_seen_examples == start + 4
+        assert len(buffer) == min(start + 4, 10)
+        if start + 4 <= 10:
+            assert buffer.labels[: start + 4].tolist() == list(range(start + 4))
+    stored = buffer.labels.tolist()
+    # every example is stored at most once, in its own slot or in an earlier one
+    assert len(set(stored)) == len(stored)
+    assert all(example >= slot for slot, example in enumerate(stored))
+    assert (buffer.examples.view(-1) == buffer.labels.float()).all()
+
+
+def test_compact_buffer_round_trip():
+    generator = torch.Generator().manual_seed(0)
+    inputs = torch.randint(0, 256, (8, 3, 4, 4), generator=generator).float() / 255
+    normalized = torch.randn(8, 3, 4, 4, generator=generator)
+    logits = torch.randn(8, 5, generator=generator) * 10
+    labels = torch.arange(8)
+    buffer = Buffer(8, compact=True)
+    buffer.add_data(examples=inputs, normalized=normalized, logits=logits, labels=labels)
+    assert buffer.examples.dtype == torch.uint8
+    assert buffer.normalized.dtype == torch.float16
+    assert buffer.logits.dtype == torch.float16
+    assert buffer.labels.dtype == torch.int64
+
+    out_inputs, out_normalized, out_logits, out_labels = buffer.get_data(8, shuffle=False)
+    assert out_inputs.dtype == out_normalized.dtype == out_logits.dtype == torch.float32
+    # images in [0, 1] are stored exactly on 256 levels, the other floats in half precision
+    torch.testing.assert_close(out_inputs, inputs, rtol=0, atol=1e-6)
+    torch.testing.assert_close(out_normalized, normalized, rtol=1e-3, atol=1e-3)
+    torch.testing.assert_close(out_logits, logits, rtol=1e-3, atol=1e-3)
+    assert torch.equal(out_labels, labels)
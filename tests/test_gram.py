@@ -0,0 +1,71 @@
+import torch
+
+from _models._utils import pack_gram, solve_gram, solve_gram_systems, unpack_gram
+
+
+def random_gram(size: int, rank: int = None, generator: torch.Generator = None) -> torch.Tensor:
+    # well conditioned without rank, otherwise positive definite on the first `rank` features and zero elsewhere
+    rank = size if rank is None else rank
+    features = torch.randn(rank, 4 * size, dtype=torch.float64, generator=generator)
+    gram = torch.zeros(size, size, dtype=torch.float64)
+    gram[:rank, :rank] = features @ features.T + torch.eye(rank, dtype=torch.float64)
+    return gram
+
+
+def pinv_solution(E: torch.Tensor, G: torch.Tensor) -> torch.Tensor:
+    return E @ torch.linalg.pinv(G, rtol=1e-15, hermitian=True)
+
+
+def test_solve_gram_well_conditioned():
+    generator = torch.Generator().manual_seed(0)
+    G = random_gram(8, generator=generator)
+    E = torch.randn(5, 8, dtype=torch.float64, generator=generator)
+    torch.testing.assert_close(solve_gram(E, G), pinv_solution(E, G))
+
+
+def test_solve_gram_singular():
+    generator = torch.Generator().manual_seed(1)
+    G = random_gram(8, rank=5, generator=generator)
+    E = torch.randn(5, 8, dtype=torch.float64, generator=generator)
+    X = solve_gram(E, G)
+    assert torch.isfinite(X).all()
+    torch.testing.assert_close(X, pinv_solution(E, G))
+
+
+def test_solve_gram_batched():
+    generator = torch.Generator().manual_seed(2)
+    G = torch.stack([random_gram(6, rank, generator) for rank in (6, 3, 6, 0)])
+    E = torch.randn(4, 3, 6, dtype=torch.float64, generator=generator)
+    X = solve_gram(E, G)
+    for i in range(len(G)):
+        torch.testing.assert_close(X[i], pinv_solution(E[i], G[i]))
+
+
+def test_solve_gram_systems_chunked():
+    generator = torch.Generator().manual_seed(3)
+    systems = {}
+    for i, (size, rank) in enumerate([(6, 6), (6, 2), (6, 6), (4, 4), (4, 1), (6, 6)]):
+        E = torch.randn(3, size, dtype=torch.float64, generator=generator)
+        systems[f"layer{i}"] = (E, random_gram(size, rank, generator))
+    expected = {key: pinv_solution(E, G) for key, (E, G) in systems.items()}
+    # a single batch per shape, batches of two systems, and a budget smaller than any system (one at a time)
+    for batch_size, memory_budget in [(16, 2**30), (2, 2**30), (16, 1)]:
+        solutions = solve_gram_systems(systems, batch_size=batch_size, memory_budget=memory_budget)
+        assert solutions.keys() == systems.keys()
+        for key in systems:
+            torch.testing.assert_close(solutions[key], expected[key])
+
+
+def test_pack_gram_round_trip():
+    generator = torch.Generator().manual_seed(4)
+    G = random_gram(7, generator=generator)
+    E = torch.randn(2, 7, dtype=torch.float64, generator=generator)
+    torch.testing.assert_close(unpack_gram(pack_gram(G)), G, rtol=0, atol=0)
+    # half precision keeps about three significant digits of every entry
+    G = G.to(torch.float32)
+    unpacked = unpack_gram(pack_gram(G, torch.float16))
+    assert unpacked.dtype == torch.float32
+    torch.testing.assert_close(unpacked, G, rtol=1e-3, atol=1e-3 * G.abs().max().item())
+    torch.testing.assert_close(unpacked, unpacked.T, rtol=0, atol=0)
+    expected = pinv_solution(E, G.to(torch.float64)).to(torch.float32)
+    torch.testing.assert_close(solve_gram(E.to(torch.float32), unpacked), expected, rtol=5e-2, atol=1e-3)
@@ -0,0 +1,222 @@
+import os
+import json
+import pickle
+import torch
+import numpy as np
+from collections import defaultdict
+
+
+def payload_size(payload) -> dict:
+    """Bytes needed to ship a server_info/client_info payload.
+
+    Tensors (also inside modules, through their state_dict) and numpy arrays count their raw data, grouped by
+    dtype; every other leaf counts its pickled size. A tensor referenced more than once is counted once.
+    For dict payloads, `keys` breaks the total down by top-level key.
+    """
+    by_dtype = defaultdict(int)
+    seen = set()
+
+    def visit(obj) -> int:
+        if isinstance(obj, torch.Tensor):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            size = obj.numel() * obj.element_size()
+            by_dtype[str(obj.dtype).replace("torch.", "")] += size
+            return size
+        if isinstance(obj, np.ndarray):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            by_dtype[str(obj.dtype)] += obj.nbytes
+            return obj.nbytes
+        if isinstance(obj, torch.nn.Module):
+            return visit(obj.state_dict(keep_vars=True))
+        if isinstance(obj, dict):
+            return sum(visit(k) if not isinstance(k, str) else 0 for k in obj) + sum(visit(v) for v in obj.values())
+        if isinstance(obj, (list, tuple, set)):
+            return sum(visit(v) for v in obj)
+        if obj is None:
+            return 0
+        try:
+            size = len(pickle.dumps(obj))
+        except Exception:
+            return 0
+        by_dtype["other"] += size
+        return size
+
+    if isinstance(payload, dict):
+        keys = {str(k): visit(v) for k, v in payload.items()}
+        total = sum(keys.values())
+    else:
+        keys = {}
+        total = visit(payload)
+    return {"total": total, "by_dtype": dict(by_dtype), "keys": keys}
+
+
+def format_bytes(num_bytes: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.2f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.2f} TB"
+
+
+class CommTracker:
+    """Accumulates the size of every payload exchanged between server and clients.
+
+    The server info of a round is broadcast, so it is counted once per receiving client.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.records = []
+        self.upload = 0
+        self.download = 0
+
+    def log_download(self, payload, num_receivers: int, **tags) -> dict:
+        if not self.enabled:
+            return None
+        size = payload_size(payload)
+        self.download += size["total"] * num_receivers
+        self.records.append({"direction": "download", "receivers": num_receivers, **tags, **size})
+        return size
+
+    def log_upload(self, payload, **tags) -> dict:
+        if not self.enabled:
+            return None
+        size = payload_size(payload)
+        self.upload += size["total"]
+        self.records.append({"direction": "upload", **tags, **size})
+        return size
+
+    def summary(self) -> dict:
+        return {"upload_bytes": self.upload, "download_bytes": self.download, "records": self.records}
+
+    def report(self) -> None:
+        if not self.enabled:
+            return
+        print(
+            "Communication: upload",
+            format_bytes(self.upload),
+            "| download",
+            format_bytes(self.download),
+            "| total",
+            format_bytes(self.upload + self.download),
+        )
+
+    def export(self, output_folder: str) -> None:
+        if not self.enabled:
+            return
+        os.makedirs(output_folder, exist_ok=True)
+        with open(os.path.join(output_folder, "communication.json"), "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+_BITS_DTYPES = {torch.float32: torch.int32, torch.float64: torch.int64, torch.float16: torch.int16, torch.bfloat16: torch.int16}
+
+
+class UpdateCodec:
+    """Compresses the flat parameter vector that clients ship under `key` and restores it on the server side,
+    so that aggregation methods receive ordinary client infos.
+
+    Modes:
+        none: the update is shipped as is.
+        fp16: half precision values.
+        int8: symmetric int8 quantization with one float32 scale per chunk of `chunk_size` values.
+        topk: only the `topk_ratio` largest entries of the delta with the server params, the rest of the delta is
+            kept by the client (error feedback) and added to its next update.
+        delta: lossless, ships only the bit patterns that differ from the server params (xor) and their positions.
+    fp16 and int8 quantize the delta with the server params when these are in the server info under the same key.
+    """
+
+    MODES = ["none", "fp16", "int8", "topk", "delta"]
+
+    def __init__(self, mode: str = "none", topk_ratio: float = 0.01, chunk_size: int = 4096, key: str = "params"):
+        assert mode in self.MODES, f"Unknown update codec {mode}, choose one of {self.MODES}"
+        self.mode = mode
+        self.topk_ratio = topk_ratio
+        self.chunk_size = chunk_size
+        self.key = key
+        self.residuals = {}
+
+    def _base(self, server_info: dict, update: torch.Tensor):
+        base = server_info.get(self.key, None) if isinstance(server_info, dict) else None
+        if not isinstance(base, torch.Tensor) or base.shape != update.shape:
+            return None
+        return base.detach().to(device=update.device, dtype=update.dtype)
+
+    def encode(self, client_info: dict, server_info: dict, client_idx: int) -> dict:
+        update = client_info.get(self.key, None) if isinstance(client_info, dict) else None
+        if self.mode == "none" or not isinstance(update, torch.Tensor) or not update.is_floating_point():
+            return client_info
+        update = update.detach()
+        base = self._base(server_info, update)
+        encoded = {"mode": self.mode, "shape": update.shape, "dtype": update.dtype, "relative": base is not None}
+        values = update.reshape(-1) if base is None else (update - base).reshape(-1)
+
+        if self.mode == "fp16":
+            encoded["values"] = values.half()
+        elif self.mode == "int8":
+            padding = (-values.numel()) % self.chunk_size
+            chunks = torch.nn.functional.pad(values.float(), (0, padding)).view(-1, self.chunk_size)
+            scales = chunks.abs().amax(dim=1).clamp_min(1e-12) / 127
+            encoded["values"] = torch.round(chunks / scales[:, None]).clamp_(-127, 127).to(torch.int8)
+            encoded["scales"] = scales
+        elif self.mode == "topk":
+            if base is None:
+                return client_info
+            residual = self.residuals.get(client_idx, None)
+            if residual is not None and residual.shape == values.shape:
+                values = values + residual.to(values.device)
+            k = max(1, int(values.numel() * self.topk_ratio))
+            indexes = torch.topk(values.abs(), k, sorted=False).indices
+            encoded["indexes"] = indexes.to(torch.int32 if values.numel() < 2**31 else torch.int64)
+            encoded["values"] = values[indexes]
+            residual = values.clone()
+            residual[indexes] = 0
+            self.residuals[client_idx] = residual
+        elif self.mode == "delta":
+            if base is None or update.dtype not in _BITS_DTYPES:
+                return client_info
+            bits_dtype = _BITS_DTYPES[update.dtype]
+            xor = torch.bitwise_xor(update.reshape(-1).view(bits_dtype), base.reshape(-1).view(bits_dtype))
+            indexes = torch.nonzero(xor).view(-1)
+            encoded["indexes"] = indexes.to(torch.int32 if xor.numel() < 2**31 else torch.int64)
+            encoded["values"] = xor[indexes]
+
+        client_info = dict(client_info)
+        client_info[self.key] = encoded
+        return client_info
+
+    def decode(self, client_info: dict, server_info: dict) -> dict:
+        encoded = client_info.get(self.key, None) if isinstance(client_info, dict) else None
+        if not isinstance(encoded, dict) or "mode" not in encoded:
+            return client_info
+        shape, dtype, mode = encoded["shape"], encoded["dtype"], encoded["mode"]
+        numel = int(np.prod(shape))
+        values = encoded["values"]
+        base = None
+        if encoded["relative"]:
+            base = server_info[self.key].detach().reshape(-1).to(device=values.device, dtype=dtype)
+
+        if mode == "delta":
+            bits_dtype = _BITS_DTYPES[dtype]
+            bits = base.clone().view(bits_dtype)
+            indexes = encoded["indexes"].long()
+            bits[indexes] = torch.bitwise_xor(bits[indexes], values)
+            update = bits.view(dtype)
+        else:
+            if mode == "fp16":
+                values = values.to(dtype)
+            elif mode == "int8":
+                values = (values.float() * encoded["scales"][:, None]).reshape(-1)[:numel].to(dtype)
+            elif mode == "topk":
+                values = torch.zeros(numel, dtype=dtype, device=values.device).index_put_(
+                    (encoded["indexes"].long(),), values.to(dtype)
+                )
+            update = values if base is None else base + values
+
+        client_info = dict(client_info)
+        client_info[self.key] = update.view(shape)
+        return client_info
@@ -0,0 +1,79 @@
+import os
+import json
+import torch
+from copy import deepcopy
+from types import MethodType
+from torch import nn
+
+
+class Compiler:
+    """Wraps network forwards, and optionally `observe`, with torch.compile.
+
+    Compilation happens once per class: the unbound method is compiled and then bound to every instance, so the
+    server and all the clients built from the same class share the compiled graphs. With the nn modules inlined,
+    dynamo guards on the attributes of the instance (shapes, dtypes, flags) and not on its identity, so a new
+    client or round does not trigger a recompilation. With `report`, the first call of each compiled forward
+    is also run through torch._dynamo.explain and its graph breaks are printed and exported. The explained call is a
+    dry run on a copy of the network, so the first batch of each class goes through the forward one more time.
+    """
+
+    def __init__(self, enabled: bool = False, observe: bool = False, mode: str = "default", report: bool = False):
+        self.enabled = enabled
+        self.observe = observe
+        self.mode = mode
+        self.report = report
+        self.methods = {}
+        self.reports = {}
+        if enabled and hasattr(torch._dynamo.config, "inline_inbuilt_nn_modules"):
+            torch._dynamo.config.inline_inbuilt_nn_modules = True
+
+    def method(self, cls: type, name: str, explain: bool = False):
+        key = (cls, name)
+        if key not in self.methods:
+            function = getattr(cls, name)
+            compiled = torch.compile(function, mode=self.mode)
+
+            def method(instance, *args, **kwargs):
+                if explain and self.report and key not in self.reports:
+                    self.reports[key] = self.explain(function, instance, *args, **kwargs)
+                return compiled(instance, *args, **kwargs)
+
+            self.methods[key] = method
+        return self.methods[key]
+
+    def explain(self, function, instance, *args, **kwargs) -> dict:
+        # dry run on a copy with detached inputs: hooks, saved attention maps or running statistics touched by the
+        # forward stay on the copy, and no graph is shared with the training step
+        dry_instance = deepcopy(instance)
+        args = [arg.detach() if isinstance(arg, torch.Tensor) else arg for arg in args]
+        kwargs = {key: arg.detach() if isinstance(arg, torch.Tensor) else arg for key, arg in kwargs.items()}
+        output = torch._dynamo.explain(function)(dry_instance, *args, **kwargs)
+        del dry_instance
+        name = f"{type(instance).__name__}.{function.__name__}"
+        report = {
+            "graphs": output.graph_count,
+            "graph_breaks": output.graph_break_count,
+            "ops": output.op_count,
+            "break_reasons": [reason.reason for reason in output.break_reasons],
+        }
+        print(f"{name}: {report['graphs']} graphs, {report['graph_breaks']} graph breaks")
+        for reason in report["break_reasons"]:
+            print("   ", reason)
+        return report
+
+    def setup(self, model: nn.Module) -> None:
+        if not self.enabled:
+            return
+        # the fabric wrapper calls the forward of the module it wraps
+        network = getattr(model.network, "module", model.network)
+        network.forward = MethodType(self.method(type(network), "forward", explain=True), network)
+        if self.observe:
+            model.observe = MethodType(self.method(type(model), "observe"), model)
+
+    def export(self, output_folder: str) -> None:
+        if not self.report or not self.reports:
+            return
+        os.makedirs(output_folder, exist_ok=True)
+        reports = {f"{cls.__name__}.{name}": report for (cls, name), report in self.reports.items()}
+        with open(os.path.join(output_folder, "graph_breaks.json"), "w") as f:
+            json.dump(reports, f, indent=2)
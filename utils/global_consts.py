@@ -21,9 +21,21 @@ ADDITIONAL_ARGS = {
     "participation_rate": (float, 1.0),
     "test_local": (str_to_bool, False),
     "test_local_transfer": (str_to_bool, False),
+    "eval_clients_group": (int, 0), # client models evaluated together in one pass over the test sets, 0 means as many as fit in memory
     "validation_interval": (int, 0), # 0 means no validation
     "save_models": (str_to_bool, False),
     "random_seed": (int, 42),
     "train_transform": (str, "default_train"),
     "test_transform": (str, "default_test"),
+    "async_eval": (str_to_bool, False), # evaluate a snapshot of the server while the next round trains
+    "eval_subsample": (float, 1.0), # fraction of each class evaluated after intermediate rounds, 1 means full test set
+    "profile_phases": (str_to_bool, False), # time every hook and export phase_timings.json and phase_trace.json
+    "log_comm": (str_to_bool, False), # measure server_info/client_info payload sizes
+    "update_codec": (str, "none"), # none, fp16, int8, topk or delta, applied to the "params" of client infos
+    "codec_topk_ratio": (float, 0.01),
+    "codec_chunk_size": (int, 4096),
+    "compile": (str_to_bool, False), # torch.compile the network forwards, once per class, shared by server and clients
+    "compile_observe": (str_to_bool, False), # also compile observe, dynamo breaks the graph at backward and step
+    "compile_mode": (str, "default"), # default, reduce-overhead or max-autotune
+    "compile_report": (str_to_bool, False), # print the graph breaks of each compiled forward and export graph_breaks.json
 }
@@ -0,0 +1,98 @@
+import os
+import json
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+
+class PhaseTimer:
+    """Wall-clock timer for the phases of the training loop.
+
+    Every phase is recorded as an event tagged with task, round and client, so that it can be exported both
+    as an aggregated JSON summary and as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+    When disabled, `phase` returns a shared no-op context and `iterate` returns the iterable untouched.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.events = []
+        self.origin = perf_counter()
+        self._noop = nullcontext()
+
+    def phase(self, name: str, **tags):
+        if not self.enabled:
+            return self._noop
+        return self._phase(name, tags)
+
+    @contextmanager
+    def _phase(self, name: str, tags: dict):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append((name, start - self.origin, perf_counter() - start, tags))
+
+    def iterate(self, iterable, name: str = "data_loading", **tags):
+        # times only the wait for the next item, not the work done on it
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name, tags)
+
+    def _iterate(self, iterable, name: str, tags: dict):
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.events.append((name, start - self.origin, perf_counter() - start, tags))
+            yield item
+
+    def summary(self) -> dict:
+        phases = defaultdict(lambda: {"count": 0, "total_s": 0.0, "max_s": 0.0})
+        breakdown = defaultdict(lambda: {"count": 0, "total_s": 0.0})
+        for name, _, duration, tags in self.events:
+            stats = phases[name]
+            stats["count"] += 1
+            stats["total_s"] += duration
+            stats["max_s"] = max(stats["max_s"], duration)
+            key = "/".join([f"{k}={v}" for k, v in sorted(tags.items())] + [name])
+            breakdown[key]["count"] += 1
+            breakdown[key]["total_s"] += duration
+        for stats in phases.values():
+            stats["mean_s"] = stats["total_s"] / stats["count"]
+        return {"phases": dict(phases), "breakdown": dict(breakdown)}
+
+    def chrome_trace(self) -> dict:
+        trace_events = []
+        threads = {}
+        for name, start, duration, tags in self.events:
+            # one trace row for the server and one for each client
+            row = f"client {tags['client']}" if "client" in tags else "server"
+            if row not in threads:
+                threads[row] = len(threads)
+                trace_events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": threads[row], "args": {"name": row}})
+            trace_events.append(
+                {
+                    "name": name,
+                    "cat": "phase",
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": 0,
+                    "tid": threads[row],
+                    "args": tags,
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def export(self, output_folder: str) -> None:
+        if not self.enabled:
+            return
+        os.makedirs(output_folder, exist_ok=True)
+        with open(os.path.join(output_folder, "phase_timings.json"), "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(os.path.join(output_folder, "phase_trace.json"), "w") as f:
+            json.dump(self.chrome_trace(), f)
+        print(f"Phase timings saved in {output_folder}")
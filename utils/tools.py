@@ -1,6 +1,7 @@
 import torch
 from torch import optim
 from torch.nn import functional as F
+from torch.func import functional_call, vmap, grad, jacrev
 from tqdm import tqdm
 from torch.cuda.amp import GradScaler
 
@@ -92,3 +93,65 @@ def compute_fisher_expectation_fabric(
 
     fish = fish / counter
     return fish.unsqueeze(0)
+
+
+def compute_fisher_diag(
+    network, data_loader, device="cuda:0", transform=None, output_slice=None, top_k=0, chunk_size=16
+):
+    """Diagonal of the Fisher information of `network`, summed over the samples of `data_loader`.
+
+    Per-sample gradients of a whole batch are computed at once with torch.func (vmap over grad/jacrev).
+    With top_k == 0 each sample contributes p(y|x) * grad(log p(y|x))^2 for its label y, as the per-example loops
+    of EWC and FisherAvg; with top_k > 0 it contributes the expectation sum_c p(c|x) * grad(log p(c|x))^2 over
+    its top_k most likely classes. Outputs are restricted to `output_slice` (start, end) and labels are shifted
+    by its start. `chunk_size` bounds how many samples are vectorized together (memory), None vectorizes the whole
+    batch. The network is evaluated in eval mode (no dropout), its mode is restored afterwards.
+    Returns a flat vector ordered as `network.parameters()`, zero for the frozen parameters.
+    """
+    training_status = network.training
+    network.eval()
+    all_params = list(network.named_parameters())
+    params = {n: p.detach() for n, p in all_params if p.requires_grad}
+    buffers = {n: b.detach() for n, b in network.named_buffers()}
+    start, end = output_slice if output_slice is not None else (0, None)
+
+    def log_probs(p, x):
+        out = functional_call(network, (p, buffers), (x.unsqueeze(0),))[0, start:end]
+        return F.log_softmax(out.float(), dim=-1)
+
+    if top_k <= 0:
+
+        def label_log_prob(p, x, y):
+            log_prob = log_probs(p, x).gather(0, y.unsqueeze(0)).squeeze(0)
+            return log_prob, log_prob.detach()
+
+        def sample_fisher(p, x, y):
+            grads, log_prob = grad(label_log_prob, has_aux=True)(p, x, y)
+            weight = log_prob.exp()
+            return {n: weight * g.float().pow(2) for n, g in grads.items()}
+
+    else:
+
+        def top_log_probs(p, x):
+            values = torch.topk(log_probs(p, x), top_k).values
+            return values, values.detach()
+
+        def sample_fisher(p, x, y):
+            jacobians, values = jacrev(top_log_probs, has_aux=True)(p, x)
+            weights = values.exp()
+            return {n: torch.tensordot(weights, j.float().pow(2), dims=1) for n, j in jacobians.items()}
+
+    batched_fisher = vmap(sample_fisher, in_dims=(None, 0, 0), chunk_size=chunk_size)
+    fish = {n: torch.zeros_like(p, dtype=torch.float32) for n, p in params.items()}
+    for images, labels in tqdm(data_loader, desc="Computing Fisher"):
+        images, labels = images.to(device), labels.to(device).long()
+        if transform is not None:
+            images = transform(images)
+        with torch.no_grad():
+            batch_fish = batched_fisher(params, images, labels - start)
+        for n in fish:
+            fish[n] += batch_fish[n].sum(0)
+    network.train(training_status)
+    return torch.cat(
+        [fish[n].reshape(-1) if n in fish else torch.zeros(p.numel(), device=p.device) for n, p in all_params]
+    )
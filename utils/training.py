@@ -1,13 +1,22 @@
 import os
 import torch
 import wandb
+import weakref
+import threading
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 from typing import List
+from torch import nn
+from torch.utils.data import DataLoader, Subset
 
 from _datasets._utils import BaseDataset
 from utils.global_consts import LOG_LOSS_INTERVAL
 from _models._utils import BaseModel
 from utils.status import progress_bar
+from utils.profiling import PhaseTimer
+from utils.communication import CommTracker, UpdateCodec, format_bytes
+from utils.compilation import Compiler
 from utils.tools import get_time_str
 
 import numpy as np
@@ -58,8 +67,81 @@ def accs_and_forgetting_matrix(accuracies: List[List[float]], forgetting: List[f
     plt.savefig(forg_path)
     return [acc_path, forg_path]
 
-def evaluate(fabric, task, model: BaseModel, dataset: BaseDataset, return_responses = False):
-    correct, total = 0, 0
+_loaders_lock = threading.Lock()
+
+
+def _get_test_loaders(dataset: BaseDataset, t: int):
+    # get_cur_dataloaders stores the loaders on the dataset, so concurrent evaluations must not interleave
+    with _loaders_lock:
+        if dataset.IS_TEXT:
+            return dataset.get_cur_dataloaders_oos(t)[1]
+        return dataset.get_cur_dataloaders(t)[1]
+
+
+# stratified test subsets drawn so far, per dataset
+_subset_indexes = weakref.WeakKeyDictionary()
+
+
+def _dataset_targets(dataset) -> np.ndarray:
+    targets = getattr(dataset, "targets", None)
+    if targets is None:
+        # no targets attribute, the labels are read through __getitem__
+        targets = [dataset[i][1] for i in range(len(dataset))]
+    if isinstance(targets, torch.Tensor):
+        targets = targets.cpu()
+    return np.asarray(targets)
+
+
+def _stratified_indexes(dataset, fraction: float, seed) -> list:
+    targets = _dataset_targets(dataset)
+    if len(targets) == 0:
+        return None
+    rng = np.random.default_rng(seed)
+    indexes = []
+    for clas in np.unique(targets):
+        clas_indexes = np.flatnonzero(targets == clas)
+        num_samples = max(1, int(round(len(clas_indexes) * fraction)))
+        indexes.append(rng.choice(clas_indexes, num_samples, replace=False))
+    return np.sort(np.concatenate(indexes)).tolist()
+
+
+def _stratified_loader(test_loader: DataLoader, fraction: float, seed, cache: dict = None) -> DataLoader:
+    # the same seed always selects the same samples, so subsampled accuracies are comparable across rounds and the
+    # indexes are drawn once per seed (the test loaders are rebuilt every round, over the same samples)
+    key = (tuple(seed), fraction, len(test_loader.dataset))
+    if cache is None or key not in cache:
+        indexes = _stratified_indexes(test_loader.dataset, fraction, seed)
+        if cache is not None:
+            cache[key] = indexes
+    else:
+        indexes = cache[key]
+    if indexes is None:
+        return test_loader
+    # same loading settings as the full loader
+    return DataLoader(
+        Subset(test_loader.dataset, indexes),
+        test_loader.batch_size,
+        shuffle=False,
+        num_workers=test_loader.num_workers,
+        collate_fn=test_loader.collate_fn,
+        pin_memory=test_loader.pin_memory,
+        drop_last=test_loader.drop_last,
+        timeout=test_loader.timeout,
+        worker_init_fn=test_loader.worker_init_fn,
+        persistent_workers=test_loader.persistent_workers,
+    )
+
+
+def _accuracy_interval(correct: int, total: int, population: int, z: float = 1.96) -> List[float]:
+    # normal approximation with finite population correction, in percentage points
+    acc = correct / total
+    fpc = (population - total) / (population - 1) if population > 1 else 0.0
+    half_width = z * np.sqrt(max(acc * (1 - acc) / total * fpc, 0.0))
+    return [round(max(acc - half_width, 0.0) * 100, 2), round(min(acc + half_width, 1.0) * 100, 2)]
+
+
+def evaluate(fabric, task, model: BaseModel, dataset: BaseDataset, return_responses = False, subsample: float = 1.0, seed: int = 0):
+    correct, total, population = 0, 0, 0
     task_accuracies = []
     training_status = model.training
     model.eval()
@@ -73,13 +155,13 @@ def evaluate(fabric, task, model: BaseModel, dataset: BaseDataset, return_respon
     with torch.no_grad():
         for t in range(task + 1):
             task_correct, task_total = 0, 0
-            #if isinstance(dataset, SequentialOOS):
-            if dataset.IS_TEXT:
-                test_loaders = dataset.get_cur_dataloaders_oos(t)[1]
-            else:
-                test_loaders = dataset.get_cur_dataloaders(t)[1]
-            # test_loaders = dataset.get_cur_dataloaders(t)[1]
-            for test_loader in test_loaders:
+            test_loaders = _get_test_loaders(dataset, t)
+            for i, test_loader in enumerate(test_loaders):
+                population += len(test_loader.dataset)
+                if subsample < 1:
+                    test_loader = _stratified_loader(
+                        test_loader, subsample, [seed, t, i], _subset_indexes.setdefault(dataset, {})
+                    )
                 test_loader = fabric.setup_dataloaders(test_loader)
                 for inputs, labels in test_loader:
                     outputs = model(dataset.test_transform(inputs))[:, start_class:end_class]
@@ -101,85 +183,255 @@ def evaluate(fabric, task, model: BaseModel, dataset: BaseDataset, return_respon
         task_accuracies,
     )
     res = [round(correct / total * 100, 2), task_accuracies]
+    if subsample < 1:
+        res.append(_accuracy_interval(correct, total, population))
+        print(f"Evaluated on {total}/{population} samples, 95% CI: {res[2]}")
     return res if not return_responses else [res, labels_tensor, responses_tensor]
 
 
-def evaluate_client(fabric, task, model: BaseModel, dataset: BaseDataset, idx: int):
-    correct, total = 0, 0
-    task_accuracies = []
-    training_status = model.training
-    model.eval()
-    start_class = 0
+def _clients_group_size(models: List[BaseModel], memory_fraction: float = 0.5) -> int:
+    # client models that fit together in a fraction of the free device memory, the rest is left for the activations
+    if len(models) == 0:
+        return 1
+    device = torch.device(models[0].device)
+    if device.type != "cuda" or not torch.cuda.is_available():
+        return len(models)
+    free_bytes, _ = torch.cuda.mem_get_info(device)
+    model_bytes = sum(tensor.numel() * tensor.element_size() for tensor in models[0].state_dict().values())
+    return max(1, min(len(models), int(free_bytes * memory_fraction // max(model_bytes, 1))))
+
+
+def evaluate_clients(
+    fabric,
+    task,
+    models: List[BaseModel],
+    dataset: BaseDataset,
+    client_idxs: List[int],
+    local: bool,
+    transfer: bool,
+    group_size: int = 0,
+) -> dict:
+    # every test batch is loaded and transformed once and fed to all the client models of a group that need it,
+    # only the `group_size` models of the current group are on the device at the same time (0: as many as fit)
+    num_models = len(models)
+    num_tasks = task + 1
+    correct = {"local": np.zeros((num_models, num_tasks)), "transfer": np.zeros((num_models, num_tasks))}
+    total = {"local": np.zeros((num_models, num_tasks)), "transfer": np.zeros((num_models, num_tasks))}
     if isinstance(dataset.N_CLASSES_PER_TASK, list):
         end_class = sum(dataset.N_CLASSES_PER_TASK[: task + 1])
     else:
         end_class = (task + 1) * dataset.N_CLASSES_PER_TASK
-    with torch.no_grad():
-        for t in range(task + 1):
-            task_correct, task_total = 0, 0
-            if dataset.IS_TEXT:
-                test_loader = dataset.get_cur_dataloaders_oos(t)[1][idx]
-            else:
-                test_loader = dataset.get_cur_dataloaders(t)[1][idx]
-            test_loader = fabric.setup_dataloaders(test_loader)
-            for inputs, labels in test_loader:
-                outputs = model(dataset.test_transform(inputs))[:, start_class:end_class]
-                pred = torch.max(outputs, dim=1)[1]
-                task_correct += (pred == labels).sum().item()
-                task_total += labels.shape[0]
-                correct += (pred == labels).sum().item()
-                total += labels.shape[0]
-            task_accuracies.append(round(task_correct / task_total * 100, 2))
+    if group_size <= 0:
+        group_size = _clients_group_size(models)
+    for start in range(0, num_models, group_size):
+        group = list(range(start, min(start + group_size, num_models)))
+        training_status = [models[j].training for j in group]
+        for j in group:
+            models[j].to(models[j].device)
+            models[j].eval()
+        with torch.no_grad():
+            for t in range(num_tasks):
+                test_loaders = _get_test_loaders(dataset, t)
+                for loader_idx, test_loader in enumerate(test_loaders):
+                    # (model position, kind of accuracy) pairs that need this loader
+                    targets = []
+                    for j in group:
+                        if loader_idx == client_idxs[j] and local:
+                            targets.append((j, "local"))
+                        elif loader_idx != client_idxs[j] and transfer:
+                            targets.append((j, "transfer"))
+                    if len(targets) == 0:
+                        continue
+                    test_loader = fabric.setup_dataloaders(test_loader)
+                    for inputs, labels in test_loader:
+                        inputs = dataset.test_transform(inputs)
+                        for j, kind in targets:
+                            outputs = models[j](inputs)[:, 0:end_class]
+                            pred = torch.max(outputs, dim=1)[1]
+                            correct[kind][j, t] += (pred == labels).sum().item()
+                            total[kind][j, t] += labels.shape[0]
+        for j, status in zip(group, training_status):
+            models[j].train(status)
+            models[j].to("cpu")
+        torch.cuda.empty_cache()
 
-    model.train(training_status)
-    print(
-        f"Mean accuracy up to task {task + 1}:",
-        round(correct / total * 100, 2),
-        "%",
-        "Task accuracies:",
-        task_accuracies,
-    )
-    res = [round(correct / total * 100, 2), task_accuracies]
-    return res
+    results = {}
+    for j, client_idx in enumerate(client_idxs):
+        results[client_idx] = {}
+        for kind, enabled in (("local", local), ("transfer", transfer)):
+            if not enabled or total[kind][j].sum() == 0:
+                continue
+            task_accuracies = [
+                round(c / n * 100, 2) if n > 0 else 0.0 for c, n in zip(correct[kind][j], total[kind][j])
+            ]
+            results[client_idx][kind] = [round(correct[kind][j].sum() / total[kind][j].sum() * 100, 2), task_accuracies]
+    return results
 
 
-def evaluate_client_transfer(fabric, task, model: BaseModel, dataset: BaseDataset, idx: int):
-    correct, total = 0, 0
-    task_accuracies = []
-    training_status = model.training
-    model.eval()
-    start_class = 0
-    if isinstance(dataset.N_CLASSES_PER_TASK, list):
-        end_class = sum(dataset.N_CLASSES_PER_TASK[: task + 1])
-    else:
-        end_class = (task + 1) * dataset.N_CLASSES_PER_TASK
-    with torch.no_grad():
-        for t in range(task + 1):
-            task_correct, task_total = 0, 0
-            test_loaders = dataset.get_cur_dataloaders(t)[1]
-            for i, test_loader in enumerate(test_loaders):
-                if i == idx:
-                    continue
-                test_loader = fabric.setup_dataloaders(test_loader)
-                for inputs, labels in test_loader:
-                    outputs = model(dataset.test_transform(inputs))[:, start_class:end_class]
-                    pred = torch.max(outputs, dim=1)[1]
-                    task_correct += (pred == labels).sum().item()
-                    task_total += labels.shape[0]
-                    correct += (pred == labels).sum().item()
-                    total += labels.shape[0]
-                task_accuracies.append(round(task_correct / task_total * 100, 2))
+def _shared_memo(model: BaseModel, dataset: BaseDataset) -> dict:
+    # fabric, its strategy and the dataset are shared with the copies instead of being copied
+    fabric = model.fabric
+    memo = {id(fabric): fabric, id(dataset): dataset}
+    strategy = getattr(fabric, "strategy", None)
+    if strategy is not None:
+        memo[id(strategy)] = strategy
+        precision = getattr(strategy, "precision", None)
+        if precision is not None:
+            memo[id(precision)] = precision
+    return memo
 
-    model.train(training_status)
-    print(
-        f"Mean accuracy up to task {task + 1}:",
-        round(correct / total * 100, 2),
-        "%",
-        "Task accuracies:",
-        task_accuracies,
-    )
-    res = [round(correct / total * 100, 2), task_accuracies]
-    return res
+
+def snapshot_model(model: BaseModel, dataset: BaseDataset) -> BaseModel:
+    return deepcopy(model, _shared_memo(model, dataset))
+
+
+def _signature(value, seen=None):
+    # storage and version of every tensor reachable from the value, to tell whether it changed since the last copy
+    if isinstance(value, torch.Tensor):
+        return (value.data_ptr(), value._version, tuple(value.shape), value.dtype)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return id(value)
+    seen.add(id(value))
+    if isinstance(value, nn.Module):
+        return tuple((name, _signature(tensor, seen)) for name, tensor in value.state_dict(keep_vars=True).items())
+    if isinstance(value, dict):
+        return tuple((key, _signature(item, seen)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_signature(item, seen) for item in value))
+    if hasattr(value, "__dict__") and not isinstance(value, type):
+        return (type(value), _signature(vars(value), seen))
+    return id(value)
+
+
+class AsyncEvaluator:
+    """Runs the per-round server evaluation on a background thread, against a snapshot of the server model,
+    while the clients of the next round are training. At most one evaluation is in flight.
+
+    The server model is copied once into a reusable evaluation model. Each submit only snapshots, on CPU, the tensors
+    of its submodules that changed since the previous one (a different storage or an in-place update), so the frozen
+    backbone is not copied again. Besides those, only the attributes the model declares in `checkpoint_attributes` and
+    `eval_attributes` are copied, when they changed, together with its plain scalar attributes.
+    """
+
+    def __init__(self, fabric, dataset: BaseDataset):
+        self.fabric = fabric
+        self.dataset = dataset
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.model = None
+        self.signatures = {}
+        self.attribute_signatures = {}
+
+    @staticmethod
+    def modules(model: BaseModel) -> dict:
+        return {name: module for name, module in model._modules.items() if module is not None}
+
+    @staticmethod
+    def attribute_names(model: BaseModel) -> list:
+        names = dict.fromkeys(model.checkpoint_attributes + model.eval_attributes)
+        return [name for name in names if name not in model._modules and hasattr(model, name)]
+
+    def snapshot(self, model: BaseModel) -> dict:
+        modules, eval_modules = self.modules(model), self.modules(self.model)
+        if modules.keys() != eval_modules.keys():
+            self.model = None
+            return None
+        state = {}
+        for module_name, module in modules.items():
+            state_dict = module.state_dict()
+            eval_state_dict = eval_modules[module_name].state_dict()
+            if state_dict.keys() != eval_state_dict.keys() or any(
+                tensor.shape != eval_state_dict[name].shape or tensor.dtype != eval_state_dict[name].dtype
+                for name, tensor in state_dict.items()
+            ):
+                # a submodule changed structure (e.g. a grown head), copy the model again
+                self.model = None
+                return None
+            state[module_name] = {}
+            for name, tensor in state_dict.items():
+                signature = (tensor.data_ptr(), tensor._version)
+                if self.signatures.get((module_name, name)) != signature:
+                    self.signatures[(module_name, name)] = signature
+                    state[module_name][name] = tensor.detach().to("cpu", copy=True)
+        return state
+
+    def attributes(self, model: BaseModel) -> dict:
+        attributes = {
+            key: value
+            for key, value in vars(model).items()
+            if not key.startswith("_") and key != "training" and isinstance(value, (bool, int, float, str))
+        }
+        changed = []
+        for name in self.attribute_names(model):
+            signature = _signature(getattr(model, name))
+            if self.attribute_signatures.get(name) != signature:
+                self.attribute_signatures[name] = signature
+                changed.append(name)
+        if len(changed) > 0:
+            # tensors of the server submodules referenced by the attributes are mapped to the ones of the evaluation model
+            memo = _shared_memo(model, self.dataset)
+            eval_modules = self.modules(self.model)
+            for module_name, module in self.modules(model).items():
+                eval_tensors = eval_modules[module_name].state_dict(keep_vars=True)
+                for name, tensor in module.state_dict(keep_vars=True).items():
+                    memo[id(tensor)] = eval_tensors[name]
+            attributes.update(deepcopy({name: getattr(model, name) for name in changed}, memo))
+        return attributes
+
+    def prepare(self, model: BaseModel):
+        if self.model is not None:
+            state = self.snapshot(model)
+            if state is not None:
+                return state, self.attributes(model)
+        self.model = snapshot_model(model, self.dataset)
+        self.signatures = {
+            (module_name, name): (tensor.data_ptr(), tensor._version)
+            for module_name, module in self.modules(model).items()
+            for name, tensor in module.state_dict().items()
+        }
+        self.attribute_signatures = {name: _signature(getattr(model, name)) for name in self.attribute_names(model)}
+        return {}, {}
+
+    def evaluate(self, task: int, state: dict, attributes: dict, **eval_kwargs):
+        modules = self.modules(self.model)
+        for module_name, module_state in state.items():
+            if len(module_state) > 0:
+                modules[module_name].load_state_dict(module_state, strict=False)
+        vars(self.model).update(attributes)
+        return evaluate(self.fabric, task, self.model, self.dataset, **eval_kwargs)
+
+    def submit(self, task: int, comm_round: int, model: BaseModel, **eval_kwargs) -> None:
+        assert self.pending is None, "Collect the previous evaluation before submitting a new one."
+        state, attributes = self.prepare(model)
+        future = self.executor.submit(self.evaluate, task, state, attributes, **eval_kwargs)
+        self.pending = (task, comm_round, future)
+
+    def collect(self):
+        if self.pending is None:
+            return None
+        task, comm_round, future = self.pending
+        self.pending = None
+        return task, comm_round, future.result()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+def log_round_accuracy(args: dict, task: int, comm_round: int, accuracy: list) -> None:
+    if args["wandb"]:
+        results = {
+            "Mean_accuracy": accuracy[0],
+            "task": task + 1,
+            "comm_round": comm_round + 1 + task * args["num_comm_rounds"],
+        }
+        for i in range(len(accuracy[1])):
+            results[f"Task_{i + 1}_accuracy"] = accuracy[1][i]
+        if len(accuracy) > 2:
+            results["Mean_accuracy_ci_low"], results["Mean_accuracy_ci_high"] = accuracy[2]
+        wandb.log(results)
 
 
 def train(
@@ -198,6 +450,10 @@ def train(
         wandb.init(project=args["wandb_project"], entity=args["wandb_entity"], config=args, name=name)
         # args.wandb_url = wandb.run.get_url()
 
+    if args["save_models"] and not args["debug_mode"]:
+        # before any checkpoint or training changes the network
+        server_model.fingerprint_network()
+
     if args["checkpoint"] is not None and args["checkpoint"] != "":
         start_task, start_comm_round = server_model.load_checkpoint(args["checkpoint"])
         print(f"Loaded checkpoint at {args['checkpoint']}")
@@ -208,10 +464,20 @@ def train(
     for client_model in client_models:
         client_model.train()
 
+    compiler = Compiler(args["compile"], args["compile_observe"], args["compile_mode"], args["compile_report"])
+    for model in [server_model] + client_models:
+        compiler.setup(model)
+
     if not args["debug_mode"]:
         os.makedirs(output_folder, exist_ok=True)
 
     total_client_indexes = torch.tensor(list(range(args["num_clients"])))
+    async_evaluator = AsyncEvaluator(fabric, dataset) if args["async_eval"] else None
+    # intermediate rounds may use a fixed stratified subset, task boundaries are always evaluated in full
+    round_eval_kwargs = {"subsample": args["eval_subsample"], "seed": args["random_seed"]}
+    timer = PhaseTimer(args["profile_phases"])
+    comm = CommTracker(args["log_comm"])
+    codec = UpdateCodec(args["update_codec"], args["codec_topk_ratio"], args["codec_chunk_size"])
     start_time = time()
     for task in range(dataset.N_TASKS):
         if task < start_task:
@@ -222,10 +488,11 @@ def train(
         else:
             train_loaders, test_loaders = dataset.get_cur_dataloaders(task)  # TODO: test_loaders are not used
         last_task_time = time()
-        if isinstance(dataset.N_CLASSES_PER_TASK, list):
-            server_model.begin_task(dataset.N_CLASSES_PER_TASK[task])
-        else:
-            server_model.begin_task(dataset.N_CLASSES_PER_TASK)
+        with timer.phase("begin_task", task=task):
+            if isinstance(dataset.N_CLASSES_PER_TASK, list):
+                server_model.begin_task(dataset.N_CLASSES_PER_TASK[task])
+            else:
+                server_model.begin_task(dataset.N_CLASSES_PER_TASK)
         # server_model.warmup_task_server(train_loaders)
         # server_info_warmup = server_model.get_server_info()
         # client_info_warmup = []
@@ -236,19 +503,27 @@ def train(
         for index, client_model in zip(active_clients_sampled, client_models):
             client_model.augment = dataset.train_transform
             client_model.test_transform = dataset.test_transform
-            if isinstance(dataset.N_CLASSES_PER_TASK, list):
-                client_model.begin_task(dataset.N_CLASSES_PER_TASK[task])
-            else:
-                client_model.begin_task(dataset.N_CLASSES_PER_TASK)
+            with timer.phase("begin_task", task=task, client=index):
+                if isinstance(dataset.N_CLASSES_PER_TASK, list):
+                    client_model.begin_task(dataset.N_CLASSES_PER_TASK[task])
+                else:
+                    client_model.begin_task(dataset.N_CLASSES_PER_TASK)
             train_loader = train_loaders[index]
             train_loader = fabric.setup_dataloaders(train_loader)
             # client_info_warmup.append(client_model.warmup_task_client(server_info_warmup, train_loader))
         for comm_round in range(args["num_comm_rounds"]):
             # server_model.begin_round_server(client_info_warmup)
-            server_model.begin_round_server()
-            server_info = server_model.get_server_info()
+            with timer.phase("begin_round_server", task=task, round=comm_round):
+                server_model.begin_round_server()
+            with timer.phase("get_server_info", task=task, round=comm_round):
+                server_info = server_model.get_server_info()
             if comm_round < start_comm_round:
                 continue
+            size = comm.log_download(server_info, len(active_clients_sampled), task=task, round=comm_round)
+            if size is not None:
+                print(f"Server info: {format_bytes(size['total'])} per client")
+                if args["wandb"]:
+                    wandb.log({"download_bytes": size["total"] * len(active_clients_sampled), "comm_round": comm_round + 1 + task * args["num_comm_rounds"]})
             clients_info = []
             last_round_time = time()
             # when participation_rate is 1, all clients are active, so idx and client_idx are the same
@@ -258,12 +533,16 @@ def train(
                 train_loader = fabric.setup_dataloaders(train_loader)
                 test_loader = fabric.setup_dataloaders(test_loader)
                 model = client_models[idx]
-                model.to(model.device)
-                model.begin_round_client(train_loader, server_info)
+                tags = {"task": task, "round": comm_round, "client": client_idx}
+                with timer.phase("to_device", **tags):
+                    model.to(model.device)
+                with timer.phase("begin_round_client", **tags):
+                    model.begin_round_client(train_loader, server_info)
                 for epoch in range(args["num_epochs"]):
                     last_value = None
-                    for i, (inputs, labels) in enumerate(train_loader):
-                        train_loss = model.observe(inputs, labels)
+                    for i, (inputs, labels) in enumerate(timer.iterate(train_loader, **tags)):
+                        with timer.phase("observe", **tags):
+                            train_loss = model.observe(inputs, labels)
                         t_loss = train_loss
                         if type(train_loss) == dict:
                             t_loss = train_loss[list(train_loss.keys())[0]]
@@ -290,56 +569,87 @@ def train(
                             )
                         if args["wandb"]:
                             wandb.log({"train_loss": train_loss})
-                    model.end_epoch()
+                    with timer.phase("end_epoch", **tags):
+                        model.end_epoch()
                 torch.cuda.empty_cache()
-                model.end_round_client(train_loader)
-                if args["test_local"]:
-                    accuracy = evaluate_client(fabric, task, model, dataset, client_idx)
-                    print(f"Client {client_idx} Local acc: {accuracy[0]}")
-                    if args["wandb"]:
-                        wandb.log({f"Client {client_idx} Local acc": accuracy[0], "comm_round": comm_round + 1 + task * args["num_comm_rounds"]})
-                if args["test_local_transfer"]:
-                    accuracy = evaluate_client_transfer(fabric, task, model, dataset, client_idx)
-                    print(f"Client {client_idx} Local Transfer acc: {accuracy[0]}")
-                    if args["wandb"]:
-                        wandb.log({f"Client {client_idx} Local Transfer acc": accuracy[0], "comm_round": comm_round + 1 + task * args["num_comm_rounds"]})
+                with timer.phase("end_round_client", **tags):
+                    model.end_round_client(train_loader)
 
                 if args["validation_interval"] > 0 and (comm_round + 1) % args["validation_interval"] == 0:
                     model.end_round_validation_client(train_loader, test_loader)
-                    accuracy = evaluate(fabric, task, model, dataset)
+                    with timer.phase("evaluate", **tags):
+                        accuracy = evaluate(fabric, task, model, dataset)
                     if args["wandb"]:
                         wandb.log({"Global client acc": accuracy, "comm_round": comm_round + 1 + task * args["num_comm_rounds"]})
-                model.to("cpu")
-                clients_info.append(model.get_client_info(train_loader))
+                with timer.phase("to_cpu", **tags):
+                    model.to("cpu")
+                with timer.phase("get_client_info", **tags):
+                    client_info = codec.encode(model.get_client_info(train_loader), server_info, client_idx)
+                size = comm.log_upload(client_info, **tags)
+                if size is not None:
+                    print(f"\nClient {client_idx} info: {format_bytes(size['total'])}", size["keys"])
+                    if args["wandb"]:
+                        wandb.log({f"Client {client_idx} upload_bytes": size["total"], "comm_round": comm_round + 1 + task * args["num_comm_rounds"]})
+                clients_info.append(server_model.receive_client_info(codec.decode(client_info, server_info)))
                 torch.cuda.empty_cache()
                 if len(train_loader):
                     print()
 
             print("\nRound time:", get_time_str(time() - last_round_time))
-            server_model.end_round_server(clients_info)
+            if args["test_local"] or args["test_local_transfer"]:
+                # once all the clients of the round are trained, so that they can share the passes over the test sets
+                with timer.phase("evaluate_clients", task=task, round=comm_round):
+                    local_accuracies = evaluate_clients(
+                        fabric,
+                        task,
+                        client_models[: len(active_clients_sampled)],
+                        dataset,
+                        active_clients_sampled,
+                        args["test_local"],
+                        args["test_local_transfer"],
+                        args["eval_clients_group"],
+                    )
+                for client_idx, accuracies in local_accuracies.items():
+                    for kind, name in (("local", "Local"), ("transfer", "Local Transfer")):
+                        if kind not in accuracies:
+                            continue
+                        print(f"Client {client_idx} {name} acc: {accuracies[kind][0]}")
+                        if args["wandb"]:
+                            wandb.log({f"Client {client_idx} {name} acc": accuracies[kind][0], "comm_round": comm_round + 1 + task * args["num_comm_rounds"]})
+            with timer.phase("end_round_server", task=task, round=comm_round):
+                server_model.end_round_server(clients_info)
             server_model.to(server_model.device)
-            accuracy = evaluate(fabric, task, server_model, dataset)
-            if args["wandb"]:
-                results = {
-                    "Mean_accuracy": accuracy[0],
-                    "task": task + 1 
-                }
-                for i in range(len(accuracy[1])):
-                    results[f"Task_{i + 1}_accuracy"] = accuracy[1][i]
-                wandb.log(results)
+            if async_evaluator is not None:
+                with timer.phase("evaluate_wait", task=task, round=comm_round):
+                    previous = async_evaluator.collect()
+                if previous is not None:
+                    log_round_accuracy(args, *previous)
+                with timer.phase("evaluate_snapshot", task=task, round=comm_round):
+                    async_evaluator.submit(task, comm_round, server_model, **round_eval_kwargs)
+            else:
+                with timer.phase("evaluate", task=task, round=comm_round):
+                    accuracy = evaluate(fabric, task, server_model, dataset, **round_eval_kwargs)
+                log_round_accuracy(args, task, comm_round, accuracy)
             if (
                 (epoch % args["checkpoint_interval"] == 0 or (comm_round + 1) == args["num_comm_rounds"])
                 and not args["debug_mode"]
             ) and args["save_models"]:
-                server_model.save_checkpoint(output_folder, task, comm_round)
+                with timer.phase("save_checkpoint", task=task, round=comm_round):
+                    server_model.save_checkpoint(output_folder, task, comm_round)
             torch.cuda.empty_cache()
             if args["validation_interval"] > 0 and (comm_round + 1) % args["validation_interval"] == 0:
                 server_model.end_round_validation_server(train_loader, test_loader)
                 print("Evaluation after round:")
                 accuracy = evaluate(fabric, task, server_model, dataset)
 
+        if async_evaluator is not None:
+            with timer.phase("evaluate_wait", task=task):
+                previous = async_evaluator.collect()
+            if previous is not None:
+                log_round_accuracy(args, *previous)
         client_info = []
         server_info = server_model.get_server_info()
+        comm.log_download(server_info, len(active_clients_sampled), task=task, phase="end_task")
         for idx, client_idx in enumerate(active_clients_sampled):
             train_loader = train_loaders[client_idx]
             test_loader = test_loaders[client_idx]
@@ -347,13 +657,17 @@ def train(
             test_loader = fabric.setup_dataloaders(test_loader)
             model = client_models[idx]
             model.to(model.device)
-            client_info.append(model.end_task_client(train_loader, server_info))
+            with timer.phase("end_task_client", task=task, client=client_idx):
+                client_info.append(model.end_task_client(train_loader, server_info))
+            comm.log_upload(client_info[-1], task=task, client=client_idx, phase="end_task")
             model.to("cpu")
             torch.cuda.empty_cache()
-        server_model.end_task_server(client_info=client_info)
+        with timer.phase("end_task_server", task=task):
+            server_model.end_task_server(client_info=client_info)
         server_model.to(model.device)
         torch.cuda.empty_cache()
-        accuracy = evaluate(fabric, task, server_model, dataset)
+        with timer.phase("evaluate", task=task):
+            accuracy = evaluate(fabric, task, server_model, dataset)
         accuracies_each_task.append(accuracy[1])
         print(f"Task {task + 1} time:", get_time_str(time() - last_task_time))
         print("__________\n")
@@ -370,7 +684,15 @@ def train(
 
     # TODO: it is probably needed a final evaluation here. At least for models that do something at the end_task()
 
+    if async_evaluator is not None:
+        async_evaluator.shutdown()
     print("\nTotal training time:", get_time_str(time() - start_time))
+    timer.export(output_folder)
+    comm.report()
+    comm.export(output_folder)
+    compiler.export(output_folder)
+    if args["wandb"] and comm.enabled:
+        wandb.log({"total_upload_bytes": comm.upload, "total_download_bytes": comm.download})
     for client_model in client_models:
         client_model.end_training()
     server_model.end_training()